@@ -18,7 +18,24 @@ from pydantic import BaseModel
 from tree_sitter import Point
 
 from helper import Helper
-from prompt_construction import get_all_snippets, render_prompt
+from language_server_pool import LanguageServerPool
+from lsp_cache import LSP_CACHE
+from lsp_workspace import LSP_WORKSPACES
+from overlay import DocumentOverlay
+from prompt_construction import (
+    CHUNKED_DIR,
+    get_all_snippets,
+    render_prompt,
+    strip_snippet_tokens,
+)
+from similar_code import SIMILAR_CODE_MODES, SimilarCodeService
+from similar_usage import SIMILAR_USAGE_BACKENDS
+from token_counter import (
+    TOKEN_COUNTER,
+    TOKEN_COUNTER_MODES,
+    get_token_counter,
+    set_token_counter_mode,
+)
 
 multilspy_logger = MultilspyLogger()
 CWD = os.path.dirname(os.path.abspath(__file__))
@@ -51,42 +68,129 @@ class PromptBuilder:
         model_name: str,
         log_steps: int = 1,
         debug: bool = False,
+        similar_code_mode: str = "exact",
+        lsh_bands: int = 32,
+        lsh_rows: int = 2,
+        chunk_workers: int = 1,
+        token_cache_path: Optional[str] = None,
+        lsp_cache_path: Optional[str] = None,
+        lsp_workspace_dir: Optional[str] = None,
+        similar_usage: bool = False,
+        similar_usage_backend: str = "lsp",
+        concurrent_lsp: bool = False,
+        token_counter_mode: str = "exact",
+        token_calibration_path: Optional[str] = None,
+        server_pool_size: int = 0,
+        server_pool_memory_mb: Optional[float] = None,
+        batch_similar_code: bool = False,
     ):
         self.df = pd.read_json(input_path, lines=True)
         if debug:
             self.df = self.df.head(10)
+        # Warm language servers reused across the rows of a repository
+        self.server_pool = (
+            LanguageServerPool(language, server_pool_size, server_pool_memory_mb, multilspy_logger)
+            if server_pool_size > 0
+            else None
+        )
+        if self.server_pool is not None:
+            # Rows of a repository follow each other, so that its server boots once.
+            # The index keeps the input order, restored in `store_df`
+            self.df = self.df.sort_values("encode", kind="stable")
         self.repos_storage = repos_storage
         self.output_path = output_path
         self.log_path = log_path
         self.log_steps = log_steps
         self.language = language
+        self.similar_usage = similar_usage
+        self.similar_usage_backend = similar_usage_backend
+        self.concurrent_lsp = concurrent_lsp
         self.model_name = model_name
+        self.similar_code_service = SimilarCodeService(
+            cached_dir=CHUNKED_DIR,
+            mode=similar_code_mode,
+            lsh_bands=lsh_bands,
+            lsh_rows=lsh_rows,
+            num_workers=chunk_workers,
+        )
+        if token_cache_path:
+            TOKEN_COUNTER.load(token_cache_path)
+        if lsp_cache_path:
+            LSP_CACHE.open(lsp_cache_path)
+        if lsp_workspace_dir:
+            LSP_WORKSPACES.open(lsp_workspace_dir)
+        set_token_counter_mode(token_counter_mode, language, token_calibration_path)
+        if batch_similar_code and similar_code_mode != "exact":
+            raise NotImplementedError(
+                f"Batched similar code only supports the exact mode, not {similar_code_mode}"
+            )
+        self.batch_similar_code = batch_similar_code
+
+    @staticmethod
+    def get_cursor_index(test_case) -> Point:
+        row = len(test_case["prompt"].splitlines()) - 1
+        col = len(test_case["prompt"].splitlines()[-1])
+        return Point(row=row, column=col)
+
+    def precompute_similar_code(self) -> Dict[Any, List[Dict[str, Any]]]:
+        """Retrieve similar code for every row in one batch per repository"""
+        similar_code_snippets = {}
+        for encode, group in tqdm(
+            self.df.groupby("encode", sort=False), desc="Precomputing similar code"
+        ):
+            root_path = os.path.join(self.repos_storage, encode)
+            queries = [
+                {
+                    "file_path": os.path.join(root_path, test_case["metadata"]["file"]),
+                    "content": test_case["prompt"] + test_case["right_context"],
+                    "cursor_index": self.get_cursor_index(test_case),
+                }
+                for _, test_case in group.iterrows()
+            ]
+            results = self.similar_code_service.get_similar_code_batch(
+                root_path, self.language, queries
+            )
+            similar_code_snippets.update(zip(group.index, results))
+        return similar_code_snippets
 
     def setup_test_state(self, test_case):
-        root_path = os.path.join(self.repos_storage, test_case["encode"])
+        root_path = os.path.abspath(os.path.join(self.repos_storage, test_case["encode"]))
         file_path = os.path.join(root_path, test_case["metadata"]["file"])
-        with open(file_path, "r") as f:
-            orig_file_content = f.read()
-
+        # The modified file only lives in memory, the repository on disk is left untouched
         new_file_content = test_case["prompt"] + test_case["right_context"]
-        with open(file_path, "w") as f:
-            f.write(new_file_content)
-        row = len(test_case["prompt"].splitlines()) - 1
-        col = len(test_case["prompt"].splitlines()[-1])
-        cursor_index = Point(row=row, column=col)
+        overlay = DocumentOverlay({file_path: new_file_content})
+        cursor_index = self.get_cursor_index(test_case)
 
-        config = MultilspyConfig.from_dict({"code_language": self.language})
-        language_server = SyncLanguageServer.create(
-            config, multilspy_logger, repository_root_path=root_path, 
-        )
-        return file_path, orig_file_content, cursor_index, language_server
+        if self.server_pool is not None:
+            # Taken from the pool in `language_server_session`
+            language_server = None
+        else:
+            config = MultilspyConfig.from_dict({"code_language": self.language})
+            language_server = SyncLanguageServer.create(
+                config, multilspy_logger, repository_root_path=root_path,
+            )
+        return file_path, overlay, cursor_index, language_server
+
+    def language_server_session(self, helper: Helper):
+        """Started language server of the row, booted for it or a warm one of the pool"""
+        if self.server_pool is None:
+            return LSP_WORKSPACES.start_server(helper.language_server, helper.repo_dir, self.language)
+        return self.server_pool.session(helper.repo_dir, helper.overlay)
+
+    def close(self):
+        if self.server_pool is not None:
+            logger.info(f"Language server pool: {self.server_pool.stats()}")
+            self.server_pool.close()
 
     def build_prompt(self):
         outputs = []
+        similar_code_snippets = (
+            self.precompute_similar_code() if self.batch_similar_code else {}
+        )
         for idx, row in tqdm(
             self.df.iterrows(), total=len(self.df), desc="Building prompt"
         ):
-            file_path, orig_file_content, cursor_index, language_server = (
+            file_path, overlay, cursor_index, language_server = (
                 self.setup_test_state(row)
             )
             try:
@@ -97,17 +201,29 @@ class PromptBuilder:
                     language_server=language_server,
                     language=self.language,
                     model_name=self.model_name,
+                    overlay=overlay,
                 )
                 logger.info("Helper is ready")
+                logger.info(f"Helper timings: {helper.timings}")
                 logger.info(row["encode"])
 
                 max_tries = 10
                 for i in range(max_tries):
                     try:
-                        with helper.language_server.start_server():
+                        with self.language_server_session(helper) as language_server:
+                            helper.language_server = language_server
                             logger.info("Init server success!!!")
-                            snippet_payload = get_all_snippets(helper)
-                            logger.debug(f"Snippet payload:\n{snippet_payload}")
+                            snippet_payload = get_all_snippets(
+                                helper,
+                                self.similar_code_service,
+                                similar_code_snippets.get(idx),
+                                similar_usage=self.similar_usage,
+                                similar_usage_backend=self.similar_usage_backend,
+                                concurrent_lsp=self.concurrent_lsp,
+                            )
+                            # Without their token ids, which would flood the log
+                            stored_snippets = strip_snippet_tokens(snippet_payload)
+                            logger.debug(f"Snippet payload:\n{stored_snippets}")
                             prompt, prefix, suffix, completion_options = render_prompt(
                                 snippet_payload, helper
                             )
@@ -116,7 +232,7 @@ class PromptBuilder:
                             outputs.append(
                                 BuilderOutput(
                                     model_name=self.model_name,
-                                    snippets=snippet_payload,
+                                    snippets=stored_snippets,
                                     built_prompt=prompt,
                                     prefix=prefix,
                                     suffix=suffix,
@@ -143,22 +259,23 @@ class PromptBuilder:
                 #         completion_options=None,
                 #     )
                 # )
-            finally:
-                with open(file_path, "w") as f:
-                    f.write(orig_file_content)
             logger.info("="*100)
             if len(outputs) % self.log_steps == 0:
                 self.store_df(outputs, self.log_path)
 
         self.store_df(outputs, self.output_path)
+        logger.info(f"Token counter: {get_token_counter().stats()}")
+        logger.info(f"LSP cache: {LSP_CACHE.stats()}")
+        logger.info(f"LSP workspaces: {LSP_WORKSPACES.stats()}")
+        TOKEN_COUNTER.save()
 
     def store_df(self, updates: List[BuilderOutput], path: str):
         df = self.df.copy()[: len(updates)]
-        df.reset_index(drop=True, inplace=True)
         additional_col = pd.DataFrame(
-            [item.model_dump_json() for item in updates], columns=["builder_output"]
+            [item.model_dump_json() for item in updates], columns=["builder_output"], index=df.index
         )
-        df = pd.concat([df, additional_col], axis=1)
+        # Rows grouped by repository for the server pool are written back in input order
+        df = pd.concat([df, additional_col], axis=1).sort_index()
         dir_path = os.path.dirname(path)
         if not os.path.exists(dir_path):
             os.makedirs(dir_path, exist_ok=True)
@@ -175,8 +292,26 @@ def main(args):
         model_name=args.model_name,
         log_steps=args.log_steps,
         debug=args.debug,
+        similar_code_mode=args.similar_code_mode,
+        lsh_bands=args.lsh_bands,
+        lsh_rows=args.lsh_rows,
+        chunk_workers=args.chunk_workers,
+        token_cache_path=args.token_cache_path,
+        lsp_cache_path=args.lsp_cache_path,
+        lsp_workspace_dir=args.lsp_workspace_dir,
+        similar_usage=args.similar_usage,
+        similar_usage_backend=args.similar_usage_backend,
+        concurrent_lsp=args.concurrent_lsp,
+        token_counter_mode=args.token_counter_mode,
+        token_calibration_path=args.token_calibration_path,
+        server_pool_size=args.server_pool_size,
+        server_pool_memory_mb=args.server_pool_memory_mb,
+        batch_similar_code=args.batch_similar_code,
     )
-    prompt_builder.build_prompt()
+    try:
+        prompt_builder.build_prompt()
+    finally:
+        prompt_builder.close()
 
 
 if __name__ == "__main__":
@@ -189,5 +324,42 @@ if __name__ == "__main__":
     parser.add_argument("-lang", "--language", dest="language", default="java")
     parser.add_argument("-lg", "--log-steps", dest="log_steps", type=int, default=1)
     parser.add_argument("--debug", dest="debug", action="store_true", default=False)
+    parser.add_argument(
+        "--similar-code-mode",
+        dest="similar_code_mode",
+        choices=SIMILAR_CODE_MODES,
+        default="exact",
+    )
+    parser.add_argument("--lsh-bands", dest="lsh_bands", type=int, default=32)
+    parser.add_argument("--lsh-rows", dest="lsh_rows", type=int, default=2)
+    parser.add_argument("--chunk-workers", dest="chunk_workers", type=int, default=1)
+    parser.add_argument("--token-cache", dest="token_cache_path", default=None)
+    parser.add_argument("--lsp-cache", dest="lsp_cache_path", default=None)
+    parser.add_argument("--lsp-workspaces", dest="lsp_workspace_dir", default=None)
+    parser.add_argument("--similar-usage", dest="similar_usage", action="store_true", default=False)
+    parser.add_argument(
+        "--similar-usage-backend",
+        dest="similar_usage_backend",
+        choices=SIMILAR_USAGE_BACKENDS,
+        default="lsp",
+    )
+    parser.add_argument("--concurrent-lsp", dest="concurrent_lsp", action="store_true", default=False)
+    parser.add_argument("--server-pool", dest="server_pool_size", type=int, default=0)
+    parser.add_argument(
+        "--server-pool-memory", dest="server_pool_memory_mb", type=float, default=None
+    )
+    parser.add_argument(
+        "--token-counter",
+        dest="token_counter_mode",
+        choices=TOKEN_COUNTER_MODES,
+        default="exact",
+    )
+    parser.add_argument("--token-calibration", dest="token_calibration_path", default=None)
+    parser.add_argument(
+        "--batch-similar-code",
+        dest="batch_similar_code",
+        action="store_true",
+        default=False,
+    )
     args = parser.parse_args()
     main(args)
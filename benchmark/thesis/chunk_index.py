@@ -0,0 +1,249 @@
+import hashlib
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from chunk_store import ChunkStore
+
+logger = logging.getLogger("chunk_index")
+
+EXTENSION = {
+    "java": ".java",
+    "python": ".py",
+}
+
+# Bumped whenever the fields stored for each chunk change
+FORMAT_VERSION = 4
+
+# Chunk records live in memory across rows of the same process, keyed by
+# (cached_dir, repo_dir, language)
+_INDEXES: Dict[tuple, "ChunkIndex"] = {}
+
+# Below this many files a process pool costs more than it saves
+PARALLEL_MIN_FILES = 32
+
+# Chunker of a pool worker, sent once per worker instead of once per file
+_WORKER_CHUNKER: Optional[Callable[[str, Optional[str]], List[dict]]] = None
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha1(content.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+
+def strip_file_path(chunks: List[dict]) -> List[dict]:
+    """Chunks are stored per file record, without their file path"""
+    return [{key: value for key, value in chunk.items() if key != "file_path"} for chunk in chunks]
+
+
+def _init_chunk_worker(chunker: Callable[[str, Optional[str]], List[dict]]):
+    global _WORKER_CHUNKER
+    _WORKER_CHUNKER = chunker
+
+
+def _chunk_in_worker(file_path: str, content: str) -> List[dict]:
+    return strip_file_path(_WORKER_CHUNKER(file_path, content))
+
+
+def chunk_files(
+    chunker: Callable[[str, Optional[str]], List[dict]],
+    files: List[Tuple[str, str]],
+    num_workers: int = 1,
+) -> List[List[dict]]:
+    """Chunks of every (file_path, content), in the order of `files`.
+
+    With `num_workers` > 1 the files are fanned out over a process pool whose
+    workers each hold their own copy of the chunker and its tokenizer.
+    """
+    if num_workers <= 1 or len(files) < PARALLEL_MIN_FILES:
+        return [strip_file_path(chunker(file_path, content)) for file_path, content in files]
+    file_paths = [file_path for file_path, _ in files]
+    contents = [content for _, content in files]
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=_init_chunk_worker,
+        initargs=(chunker,),
+    ) as executor:
+        return list(
+            executor.map(
+                _chunk_in_worker,
+                file_paths,
+                contents,
+                chunksize=max(1, len(files) // (num_workers * 8)),
+            )
+        )
+
+
+class ChunkIndex:
+    """Persistent per-repo chunk index keyed by file path, mtime and content hash.
+
+    Only files whose content changed since the last refresh are re-chunked.
+    """
+
+    def __init__(
+        self,
+        repo_dir: str,
+        language: str,
+        cached_dir: str,
+        chunker: Callable[[str, Optional[str]], List[dict]],
+    ):
+        self.repo_dir = repo_dir
+        self.language = language
+        self.chunker = chunker
+        repo_name = repo_dir.rstrip(os.path.sep).split(os.path.sep)[-1]
+        self.store_dir = os.path.join(cached_dir, f"{repo_name}.chunks.v{FORMAT_VERSION}")
+        # file_path -> {"mtime", "size", "hash", "chunks"}, chunks of unchanged
+        # files being views over the memory-mapped store
+        self.files: Dict[str, dict] = {}
+        # file_path -> {"hash", "chunks"} for content that is not on disk
+        self.overrides: Dict[str, dict] = {}
+        self.dirty = False
+        # Incremented whenever the chunks on disk change
+        self.version = 0
+        self.load()
+
+    def load(self):
+        try:
+            store = ChunkStore.open(self.store_dir)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Discard corrupted chunk store {self.store_dir}: {e}")
+            return
+        if store is not None:
+            self.files = store.records()
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(self.store_dir, exist_ok=True)
+        # Saved chunks are read back from the store, memory-mapped
+        self.files = ChunkStore.write(self.store_dir, self.files).records()
+        self.dirty = False
+
+    def _source_files(self) -> List[str]:
+        file_paths = []
+        for subdir, dirs, files in os.walk(self.repo_dir):
+            for file in files:
+                if file.endswith(EXTENSION[self.language]):
+                    file_paths.append(os.path.join(subdir, file))
+        return file_paths
+
+    def refresh(self, num_workers: int = 1) -> int:
+        """Re-chunk the files that changed on disk, returns the number of re-chunked files.
+
+        With `num_workers` > 1 the files are chunked by a process pool, the
+        records are identical to a sequential refresh.
+        """
+        file_paths = sorted(self._source_files())
+        stale = []
+        for file_path in file_paths:
+            stat = os.stat(file_path)
+            record = self.files.get(file_path)
+            if (
+                record
+                and record["mtime"] == stat.st_mtime_ns
+                and record["size"] == stat.st_size
+            ):
+                continue
+            stale.append((file_path, stat))
+        updated = self._update(stale, num_workers)
+        removed = self.files.keys() - set(file_paths)
+        for file_path in removed:
+            del self.files[file_path]
+        if removed:
+            self.dirty = True
+            self.version += 1
+        logger.debug(
+            f"Refreshed {self.repo_dir}: {updated} re-chunked, {len(removed)} removed"
+        )
+        return updated
+
+    def update_file(self, file_path: str, content: Optional[str] = None) -> bool:
+        """Re-chunk one file, returns whether its chunks changed.
+
+        Without `content` the file is read from disk and the persisted record is
+        updated. With `content` the chunks are kept as an in-memory override of
+        the file that is never persisted, see `discard_overrides`.
+        """
+        if content is None:
+            return self._update([(file_path, os.stat(file_path))]) > 0
+        digest = content_hash(content)
+        override = self.overrides.get(file_path)
+        if override and override["hash"] == digest:
+            return False
+        record = self.files.get(file_path)
+        if record and record["hash"] == digest:
+            return self.overrides.pop(file_path, None) is not None
+        self.overrides[file_path] = {
+            "hash": digest,
+            "chunks": self._chunk(file_path, content),
+        }
+        return True
+
+    def discard_overrides(self, keep: Optional[str] = None):
+        self.overrides = {
+            file_path: override
+            for file_path, override in self.overrides.items()
+            if file_path == keep
+        }
+
+    def _chunk(self, file_path: str, content: str) -> List[dict]:
+        return strip_file_path(self.chunker(file_path, content))
+
+    def _update(self, stale: List[Tuple[str, os.stat_result]], num_workers: int = 1) -> int:
+        """Re-chunk the files whose content changed, returns their number"""
+        changed = []
+        for file_path, stat in stale:
+            with open(file_path, "r") as f:
+                content = f.read()
+            digest = content_hash(content)
+            record = self.files.get(file_path)
+            if record and record["hash"] == digest:
+                if record["mtime"] != stat.st_mtime_ns or record["size"] != stat.st_size:
+                    record["mtime"], record["size"] = stat.st_mtime_ns, stat.st_size
+                    self.dirty = True
+                continue
+            changed.append((file_path, content, digest, stat))
+        all_chunks = chunk_files(
+            self.chunker,
+            [(file_path, content) for file_path, content, _, _ in changed],
+            num_workers,
+        )
+        for (file_path, _, digest, stat), chunks in zip(changed, all_chunks):
+            self.files[file_path] = {
+                "mtime": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "hash": digest,
+                "chunks": chunks,
+            }
+        if changed:
+            self.dirty = True
+            self.version += 1
+        return len(changed)
+
+    def file_records(self) -> Dict[str, dict]:
+        """Current record of every file, overrides taking precedence over disk"""
+        return {**self.files, **self.overrides}
+
+    def chunks(self) -> List[dict]:
+        all_chunks = []
+        for file_path in sorted(self.files.keys() | self.overrides.keys()):
+            record = self.overrides.get(file_path) or self.files[file_path]
+            for chunk in record["chunks"]:
+                all_chunks.append({**chunk, "file_path": file_path})
+        return all_chunks
+
+
+def get_chunk_index(
+    repo_dir: str,
+    language: str,
+    cached_dir: str,
+    chunker: Callable[[str, Optional[str]], List[dict]],
+) -> ChunkIndex:
+    key = (os.path.abspath(cached_dir), os.path.abspath(repo_dir), language)
+    index = _INDEXES.get(key)
+    if index is None:
+        index = ChunkIndex(repo_dir, language, cached_dir, chunker)
+        _INDEXES[key] = index
+    else:
+        index.chunker = chunker
+    return index
@@ -0,0 +1,286 @@
+import json
+import logging
+import os
+import shutil
+import time
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+from tree_sitter import Point
+
+from common_funcs import Range
+
+logger = logging.getLogger("chunk_store")
+
+CURRENT_FILE = "CURRENT"
+# Above this many segments a save compacts the store, so that opening it stays cheap
+MAX_SEGMENTS = 16
+ARRAY_NAMES = ["ranges", "content", "content_offsets", "token_ids", "token_offsets"]
+
+
+class StoredChunks:
+    """Read-only view over the chunks of one file in a `ChunkSegment`"""
+
+    def __init__(self, segment: "ChunkSegment", start: int, end: int):
+        self.segment = segment
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, i: int) -> dict:
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.segment.chunk(self.start + i)
+
+    def __iter__(self) -> Iterator[dict]:
+        for chunk_id in range(self.start, self.end):
+            yield self.segment.chunk(chunk_id)
+
+
+class ChunkSegment:
+    """Chunks of some files, as rows of flat NumPy arrays loaded with mmap.
+
+    Every chunk has an integer range, offsets into the utf-8 content blob and
+    offsets into the pre-tokenized id array. A segment is never modified once
+    written.
+    """
+
+    def __init__(self, name: str, path: str):
+        self.name = name
+        self.ranges = self._load(path, "ranges")
+        self.content = self._load(path, "content")
+        self.content_offsets = self._load(path, "content_offsets")
+        self.token_ids = self._load(path, "token_ids")
+        self.token_offsets = self._load(path, "token_offsets")
+
+    @staticmethod
+    def _load(path: str, name: str) -> np.ndarray:
+        return np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def chunk(self, chunk_id: int) -> dict:
+        content_start, content_end = self.content_offsets[chunk_id : chunk_id + 2]
+        token_start, token_end = self.token_offsets[chunk_id : chunk_id + 2]
+        start_row, start_column, end_row, end_column = self.ranges[chunk_id].tolist()
+        return {
+            "content": self.content[content_start:content_end]
+            .tobytes()
+            .decode("utf-8", errors="surrogatepass"),
+            "range": Range(Point(start_row, start_column), Point(end_row, end_column)),
+            "encoded": self.token_ids[token_start:token_end].tolist(),
+        }
+
+    @staticmethod
+    def write(path: str, records: Dict[str, dict]) -> Dict[str, Tuple[int, int]]:
+        """Write the chunks of `records` as a segment, returns the (start, end) of every file"""
+        os.makedirs(path)
+        file_ranges = {}
+        ranges, contents, content_sizes, token_arrays, token_sizes_list = [], [], [], [], []
+        n_chunks = 0
+        for file_path in sorted(records):
+            chunks = records[file_path]["chunks"]
+            if isinstance(chunks, StoredChunks):
+                # Stored files are copied array slice by array slice
+                segment, start, end = chunks.segment, chunks.start, chunks.end
+                content_start, content_end = segment.content_offsets[[start, end]]
+                token_start, token_end = segment.token_offsets[[start, end]]
+                ranges.append(np.asarray(segment.ranges[start:end]))
+                contents.append(segment.content[content_start:content_end].tobytes())
+                content_sizes.append(np.diff(segment.content_offsets[start : end + 1]))
+                token_arrays.append(np.asarray(segment.token_ids[token_start:token_end]))
+                token_sizes = np.diff(segment.token_offsets[start : end + 1])
+            else:
+                encoded_contents = [
+                    chunk["content"].encode("utf-8", errors="surrogatepass")
+                    for chunk in chunks
+                ]
+                ranges.append(
+                    np.array(
+                        [(*chunk["range"].start_point, *chunk["range"].end_point) for chunk in chunks],
+                        dtype=np.int32,
+                    ).reshape(-1, 4)
+                )
+                contents.extend(encoded_contents)
+                content_sizes.append(
+                    np.array([len(content) for content in encoded_contents], dtype=np.int64)
+                )
+                token_arrays.append(
+                    np.array(
+                        [token for chunk in chunks for token in chunk["encoded"]],
+                        dtype=np.int32,
+                    )
+                )
+                token_sizes = np.array([len(chunk["encoded"]) for chunk in chunks])
+            file_ranges[file_path] = (n_chunks, n_chunks + len(chunks))
+            n_chunks += len(chunks)
+            token_sizes_list.append(token_sizes)
+
+        def offsets(sizes: List[np.ndarray]) -> np.ndarray:
+            all_sizes = np.concatenate(sizes + [np.zeros(0, dtype=np.int64)])
+            return np.concatenate([[0], np.cumsum(all_sizes)]).astype(np.int64)
+
+        arrays = {
+            "ranges": np.concatenate(ranges + [np.zeros((0, 4), dtype=np.int32)]).astype(
+                np.int32
+            ),
+            "content": np.frombuffer(b"".join(contents), dtype=np.uint8),
+            "content_offsets": offsets(content_sizes),
+            "token_ids": np.concatenate(token_arrays + [np.zeros(0, dtype=np.int32)]).astype(
+                np.int32
+            ),
+            "token_offsets": offsets(token_sizes_list),
+        }
+        for name in ARRAY_NAMES:
+            np.save(os.path.join(path, name + ".npy"), arrays[name])
+        return file_ranges
+
+
+class ChunkStore:
+    """Append-only on-disk chunk cache of a repository.
+
+    The chunks live in immutable segments. A manifest lists every file with
+    the segment and rows of its chunks, and the CURRENT pointer names the
+    manifest in use. A save appends a segment with the files that changed only,
+    writes a new manifest and switches CURRENT to it, so readers never see a
+    partially written store. Once more chunks are dead than referenced, or
+    there are too many segments, a save compacts the live ones into a single
+    segment. The manifest replaced by a
+    save and its segments are kept until the next save, so that processes
+    still reading it have switched by then.
+    """
+
+    def __init__(self, store_dir: str, manifest_name: str):
+        self.store_dir = store_dir
+        self.manifest_name = manifest_name
+        with open(os.path.join(store_dir, manifest_name), "r") as f:
+            manifest = json.load(f)
+        self.segments = {
+            name: ChunkSegment(name, os.path.join(store_dir, name))
+            for name in manifest["segments"]
+        }
+        # [{"file_path", "mtime", "size", "hash", "segment", "start", "end"}, ...]
+        self.files: List[dict] = manifest["files"]
+
+    def records(self) -> Dict[str, dict]:
+        return {
+            file["file_path"]: {
+                "mtime": file["mtime"],
+                "size": file["size"],
+                "hash": file["hash"],
+                "chunks": StoredChunks(self.segments[file["segment"]], file["start"], file["end"]),
+            }
+            for file in self.files
+        }
+
+    @staticmethod
+    def _current(store_dir: str) -> Optional[str]:
+        try:
+            with open(os.path.join(store_dir, CURRENT_FILE), "r") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _referenced(store_dir: str, manifest_name: Optional[str]) -> Set[str]:
+        """Names of a manifest and of its segments"""
+        if manifest_name is None:
+            return set()
+        try:
+            with open(os.path.join(store_dir, manifest_name), "r") as f:
+                return {manifest_name, *json.load(f)["segments"]}
+        except (OSError, ValueError):
+            return {manifest_name}
+
+    @staticmethod
+    def open(store_dir: str) -> "ChunkStore | None":
+        manifest_name = ChunkStore._current(store_dir)
+        if manifest_name is None:
+            return None
+        return ChunkStore(store_dir, manifest_name)
+
+    @staticmethod
+    def write(store_dir: str, records: Dict[str, dict]) -> "ChunkStore":
+        """Save `records` (file_path -> {"mtime", "size", "hash", "chunks"}) as a new manifest.
+
+        Returns the saved store, whose records should replace `records` so that
+        the next save only appends the files changed since this one.
+        """
+        generation = f"{time.time_ns()}-{os.getpid()}"
+        previous = ChunkStore._current(store_dir)
+
+        # Chunks of the segments in use that no file references anymore
+        stored = [
+            record["chunks"]
+            for record in records.values()
+            if isinstance(record["chunks"], StoredChunks)
+        ]
+        segments = {chunks.segment.name: chunks.segment for chunks in stored}
+        n_dead = sum(len(segment) for segment in segments.values()) - sum(map(len, stored))
+        n_live = sum(len(record["chunks"]) for record in records.values())
+        compact = n_dead > n_live or len(segments) >= MAX_SEGMENTS
+        if compact:
+            logger.debug(f"Compact chunk store {store_dir}, dropping {n_dead} chunks")
+            segments = {}
+        changed = {
+            file_path: record
+            for file_path, record in records.items()
+            if compact or not isinstance(record["chunks"], StoredChunks)
+        }
+
+        locations = {}
+        if changed:
+            segment_name = f"s{generation}"
+            file_ranges = ChunkSegment.write(os.path.join(store_dir, segment_name), changed)
+            segments[segment_name] = None
+            locations = {
+                file_path: (segment_name, start, end)
+                for file_path, (start, end) in file_ranges.items()
+            }
+        files = []
+        for file_path in sorted(records):
+            record = records[file_path]
+            if file_path not in locations:
+                chunks = record["chunks"]
+                locations[file_path] = (chunks.segment.name, chunks.start, chunks.end)
+            segment_name, start, end = locations[file_path]
+            files.append(
+                {
+                    "file_path": file_path,
+                    "mtime": record["mtime"],
+                    "size": record["size"],
+                    "hash": record["hash"],
+                    "segment": segment_name,
+                    "start": start,
+                    "end": end,
+                }
+            )
+        manifest_name = f"m{generation}.json"
+        with open(os.path.join(store_dir, manifest_name), "w") as f:
+            json.dump({"segments": sorted(segments), "files": files}, f)
+
+        tmp_current_path = os.path.join(store_dir, f"{CURRENT_FILE}.{os.getpid()}.tmp")
+        with open(tmp_current_path, "w") as f:
+            f.write(manifest_name)
+        os.replace(tmp_current_path, os.path.join(store_dir, CURRENT_FILE))
+
+        # Readers of the previous manifest keep it until the next save
+        keep = ChunkStore._referenced(store_dir, manifest_name) | ChunkStore._referenced(
+            store_dir, previous
+        )
+        for name in os.listdir(store_dir):
+            if name[:1] not in ("m", "s") or name in keep:
+                continue
+            path = os.path.join(store_dir, name)
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError:
+                # Removed by another process saving at the same time
+                pass
+        return ChunkStore(store_dir, manifest_name)
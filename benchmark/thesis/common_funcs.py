@@ -1,20 +1,27 @@
+import itertools
 import re
-from typing import Optional, List
+import time
+from typing import Dict, Iterator, NamedTuple, Optional, List, Set, Tuple
 from textwrap import dedent
 import tree_sitter
 import tree_sitter_java as tsjava
 import tree_sitter_python as tspython
-from transformers import LlamaTokenizerFast
 from tree_sitter import Node, Point, Tree
 from pydantic import BaseModel
 import os
 import dotenv
 import logging
 
+from line_index import LineIndex, get_line_index
+from parse_cache import PARSE_CACHE
+
+logger = logging.getLogger("common_funcs")
+
 dotenv.load_dotenv(override=True)
 
 JAVA = tree_sitter.Language(tsjava.language())
 PYTHON = tree_sitter.Language(tspython.language())
+LANGUAGES = {"java": JAVA, "python": PYTHON}
 LANG_EXTENSIONS = {"java": ".java", "python": ".py"}
 FUNCTION_DECLARATION_NODE_TYPES = [
     "method_definition",
@@ -42,9 +49,57 @@ TOP_LEVEL_KEY_WORDS = {
     "java": ["class", "function"],
     "python": ["def", "class", '"""#'],
 }
-TOKENIZER = LlamaTokenizerFast.from_pretrained(
-    "hf-internal-testing/llama-tokenizer", token=os.getenv("")
+TOKENIZER_NAME = "hf-internal-testing/llama-tokenizer"
+# Local copy of the tokenizer files, written on the first load from the hub
+TOKENIZER_DIR = os.getenv(
+    "TOKENIZER_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data", "tokenizer"),
 )
+
+
+class LazyTokenizer:
+    """Stand-in for the tokenizer that loads it on first use.
+
+    The tokenizer is read from the `tokenizer.json` in `tokenizer_dir` without
+    network access. Only when it is missing is it fetched from the hub and saved
+    there. A tokenizer loaded before a fork is shared with the forked workers,
+    pickling only sends where to load it from.
+    """
+
+    def __init__(self, name_or_path: str = TOKENIZER_NAME, tokenizer_dir: str = TOKENIZER_DIR):
+        self.name_or_path = name_or_path
+        self.tokenizer_dir = tokenizer_dir
+        self._tokenizer = None
+
+    def load(self):
+        if self._tokenizer is None:
+            # transformers alone takes seconds to import
+            from transformers import LlamaTokenizerFast
+
+            if os.path.exists(os.path.join(self.tokenizer_dir, "tokenizer.json")):
+                self._tokenizer = LlamaTokenizerFast.from_pretrained(
+                    self.tokenizer_dir, local_files_only=True
+                )
+            else:
+                self._tokenizer = LlamaTokenizerFast.from_pretrained(
+                    self.name_or_path, token=os.getenv("")
+                )
+                self._tokenizer.save_pretrained(self.tokenizer_dir)
+        return self._tokenizer
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+    def __getattr__(self, name: str):
+        if name.startswith("__") or name == "_tokenizer":
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __getstate__(self):
+        return {**self.__dict__, "_tokenizer": None}
+
+
+TOKENIZER = LazyTokenizer()
 TYPES_TO_USE = {
     "arrow_function",
     "generator_function_declarationprogram",
@@ -194,9 +249,34 @@ class IRange(BaseModel):
     end_point: Point
 
 
+class Range(NamedTuple):
+    """Range in a file, from start_point to end_point, without validation.
+
+    Used for every chunk and LSP location, ranges only become an `IRange` when
+    they are written in a `BuilderOutput`.
+    """
+
+    start_point: Point
+    end_point: Point
+
+    def to_irange(self) -> IRange:
+        return IRange(start_point=self.start_point, end_point=self.end_point)
+
+    def to_json(self) -> str:
+        """Same string as `self.to_irange().model_dump_json()`"""
+        return (
+            f'{{"start_point":[{self.start_point.row},{self.start_point.column}],'
+            f'"end_point":[{self.end_point.row},{self.end_point.column}]}}'
+        )
+
+
 # Checked
-def get_ast(content: str, language: str):
-    """Returns the AST of the given content in the given language"""
+def get_ast(content: str, language: str, file_path: Optional[str] = None):
+    """Returns the AST of the given content in the given language.
+
+    Trees are cached by file and content hash, a changed file being reparsed
+    incrementally from its previous tree, see `ParseCache`.
+    """
     if language == "java":
         parser = JAVA_PARSER
     elif language == "python":
@@ -204,7 +284,7 @@ def get_ast(content: str, language: str):
     else:
         raise NotImplementedError("Language is not currently supported")
     try:
-        ast = parser.parse(bytes(content, encoding="utf-8"))
+        ast = PARSE_CACHE.parse(parser, content, language, file_path)
         return ast
     except Exception as e:
         logging.error(e)
@@ -225,78 +305,129 @@ def get_symbols_for_snippet(text: str) -> List[str]:
     return symbols
 
 
+class QueryRegistry:
+    """Tree-sitter queries of `QUERIES`, each compiled once on first use and kept
+    for the lifetime of the process, with the time every compilation took."""
+
+    def __init__(self, queries: dict = QUERIES):
+        self.queries = queries
+        # (query_type, language, node_type) -> compiled query, or None if undefined
+        self.compiled: Dict[Tuple[str, str, Optional[str]], Optional[tree_sitter.Query]] = {}
+        self.compile_times: Dict[Tuple[str, str, Optional[str]], float] = {}
+
+    def _source(self, query_type: str, language: str, node_type: Optional[str]) -> Optional[str]:
+        if query_type == "root_path_context_queries":
+            return self.queries[query_type].get(language, {}).get(node_type, None)
+        elif query_type == "import_queries":
+            return self.queries[query_type].get(language, None)
+        return None
+
+    def get(
+        self, query_type: str, language: str, node_type: Optional[str] = None
+    ) -> Optional[tree_sitter.Query]:
+        if query_type == "import_queries":
+            node_type = None
+        key = (query_type, language, node_type)
+        if key in self.compiled:
+            return self.compiled[key]
+        source = self._source(query_type, language, node_type)
+        query = None
+        if source is not None and language in LANGUAGES:
+            start = time.perf_counter()
+            query = LANGUAGES[language].query(source)
+            self.compile_times[key] = time.perf_counter() - start
+            logger.debug(f"Compiled query {key} in {self.compile_times[key]:.4f} s")
+        self.compiled[key] = query
+        return query
+
+    def compile_all(self) -> Dict[Tuple[str, str, Optional[str]], float]:
+        """Compile every query up front, returns the compile time of each"""
+        for query_type, by_language in self.queries.items():
+            for language, value in by_language.items():
+                node_types = value.keys() if isinstance(value, dict) else [None]
+                for node_type in node_types:
+                    self.get(query_type, language, node_type)
+        return self.report()
+
+    def report(self) -> Dict[Tuple[str, str, Optional[str]], float]:
+        return dict(self.compile_times)
+
+
+QUERY_REGISTRY = QueryRegistry()
+
+
 # Checked
 def get_tree_sitter_query(
     query_type: str, language: str, node_type: Optional[str] = None
 ):
-    if query_type == "root_path_context_queries":
-        if language == "java":
-            return (
-                JAVA.query(QUERIES[query_type][language][node_type])
-                if QUERIES[query_type][language].get(node_type, None)
-                else None
-            )
-        elif language == "python":
-            return (
-                PYTHON.query(QUERIES[query_type][language][node_type])
-                if QUERIES[query_type][language].get(node_type, None)
-                else None
-            )
-    elif query_type == "import_queries":
-        if language == "java":
-            return JAVA.query(QUERIES[query_type][language])
-        elif language == "python":
-            return PYTHON.query(QUERIES[query_type][language])
-    return None
+    return QUERY_REGISTRY.get(query_type, language, node_type)
 
 
 # Checked
 def get_tree_path_at_cursor(ast: Tree, cursor_index: Point) -> List[Node]:
-    path = [ast.root_node]
+    """Path from the root to the deepest node around the cursor, descending at
+    every level into the first child with start_point <= cursor <= end_point.
+
+    A TreeCursor finds that child in C, without creating a Node for each sibling.
+    """
+    cursor = ast.walk()
+    path = [cursor.node]
     while path[-1].child_count > 0:
-        found_child = False
-        for child in path[-1].children:
-            if child.start_point <= cursor_index <= child.end_point:
-                path.append(child)
-                found_child = True
+        # First child ending strictly after the cursor, or the last child
+        if cursor.goto_first_child_for_point(cursor_index) is None:
+            cursor.goto_last_child()
+        # Preceding siblings ending right at the cursor come first
+        while cursor.goto_previous_sibling():
+            if cursor.node.end_point < cursor_index:
+                cursor.goto_next_sibling()
                 break
-        if not found_child:
+        node = cursor.node
+        if not node.start_point <= cursor_index <= node.end_point:
             break
+        path.append(node)
     return path
 
 
-# Checked
-def find_children(node: Node, predicate, first_n: Optional[int] = None):
-    matching_nodes = []
-    if first_n and first_n <= 0:
-        return []
+def iter_children(
+    node: Node, predicate=None, node_types: Optional[Set[str]] = None
+) -> Iterator[Node]:
+    """Lazily yields the nodes of the subtree of `node`, itself included, in pre-order.
+
+    Only nodes whose type is in `node_types` are passed to `predicate`, so a
+    type filter alone never calls back into Python.
+    """
+    cursor = node.walk()
+    while True:
+        current = cursor.node
+        if (node_types is None or current.type in node_types) and (
+            predicate is None or predicate(current)
+        ):
+            yield current
+        if cursor.goto_first_child():
+            continue
+        # The cursor cannot leave the subtree it was created on
+        while not cursor.goto_next_sibling():
+            if not cursor.goto_parent():
+                return
 
-    # Check if the current node's type is in the list of types we're interested in
-    if predicate(node):
-        matching_nodes.append(node)
-
-    # Recursively search for matching types in all children of the current node
-    for child in node.children:
-        matching_nodes.extend(
-            find_children(
-                child, predicate, first_n - len(matching_nodes) if first_n else None
-            )
-        )
 
-    return matching_nodes
+# Checked
+def find_children(
+    node: Node,
+    predicate=None,
+    first_n: Optional[int] = None,
+    node_types: Optional[Set[str]] = None,
+) -> List[Node]:
+    """Matching nodes of the subtree in pre-order, stopping after `first_n` of them"""
+    if first_n is not None and first_n <= 0:
+        return []
+    return list(itertools.islice(iter_children(node, predicate, node_types), first_n))
 
 
 # Checked
-def read_range_in_file(file_path: str, range: IRange):
-    """Reads a range of text from a file."""
-    with open(file_path, "r") as f:
-        lines = f.read().splitlines()
-
-    content = ""
-    for line in lines[range.start_point.row : range.end_point.row]:
-        content += line + "\n"
-    content += lines[range.end_point.row][: range.end_point.column]
-    return content
+def read_range_in_file(file_path: str, range: Range, overlay=None):
+    """Reads a range of text from a file, through the shared line index of the file"""
+    return get_line_index(file_path, overlay).read_range(range)
 
 
 # Need fix
@@ -307,38 +438,32 @@ def find_type_identifiers(root_node: Node) -> List[Node]:
         or (
             node.parent
             and node.parent.type == "ERROR"
-            and node.type == "identifier"
             and node.text.decode("utf-8")[0].isupper()
         ),
+        node_types={"type_identifier", "identifier"},
     )
 
 
 # Checked
 def point2index(content: str, point: Point) -> int:
-    content = content.replace("\r\n", "\n")
-    lines = content.splitlines()
-    index = 0
-    for i in range(point.row):
-        index += len(lines[i]) + 1
-    index += point.column
-    return index
+    """Prefer the `LineIndex` of the document when converting several points"""
+    return LineIndex(content).point_to_index(point)
 
 
 # Checked
-def lsprange2irange(lsprange: dict) -> IRange:
-    return IRange(
-        start_point=Point(
-            row=lsprange["start"]["line"],
-            column=lsprange["start"]["character"],
-        ),
-        end_point=Point(
-            row=lsprange["end"]["line"], column=lsprange["end"]["character"]
-        ),
+def lsprange2range(lsprange: dict) -> Range:
+    return Range(
+        Point(lsprange["start"]["line"], lsprange["start"]["character"]),
+        Point(lsprange["end"]["line"], lsprange["end"]["character"]),
     )
 
 
+def lsprange2irange(lsprange: dict) -> IRange:
+    return lsprange2range(lsprange).to_irange()
+
+
 # Need fix
-def intersection(a: IRange, b: IRange) -> Optional[IRange]:
+def intersection(a: Range, b: Range) -> Optional[Range]:
     start_row = max(a.start_point.row, b.start_point.row)
     end_row = min(a.end_point.row, b.end_point.row)
     if start_row > end_row:
@@ -351,10 +476,7 @@ def intersection(a: IRange, b: IRange) -> Optional[IRange]:
         if start_column > end_column:
             return None
 
-        return IRange(
-            start_point=Point(row=start_row, column=start_column),
-            end_point=Point(row=end_row, column=end_column),
-        )
+        return Range(Point(start_row, start_column), Point(end_row, end_column))
 
     start_column = (
         a.start_point.column if start_row == a.start_point.row else b.start_point.column
@@ -363,7 +485,4 @@ def intersection(a: IRange, b: IRange) -> Optional[IRange]:
         a.end_point.column if end_row == a.end_point.row else b.end_point.column
     )
 
-    return IRange(
-        start_point=Point(row=start_row, column=start_column),
-        end_point=Point(row=end_row, column=end_column),
-    )
+    return Range(Point(start_row, start_column), Point(end_row, end_column))
@@ -1,7 +1,13 @@
-from typing import NamedTuple
+from typing import Dict, NamedTuple
 from tree_sitter import Point
+import bisect
+import itertools
 import os
-from common_funcs import get_tree_path_at_cursor, get_ast, point2index
+import time
+from common_funcs import get_tree_path_at_cursor, get_ast
+from line_index import get_line_index
+from overlay import DocumentOverlay
+from token_counter import get_token_counter
 from utils import count_tokens
 
 
@@ -38,7 +44,8 @@ class Helper:
         language_server,
         language: str = "java",
         model_name: str = "codestral-latest",
-        suffix: str | None = None
+        suffix: str | None = None,
+        overlay: DocumentOverlay | None = None,
     ):
         self.repo_dir = repo_dir
         self.language = language
@@ -47,14 +54,19 @@ class Helper:
         self.cursor_index = cursor_index
         self.model_name = model_name
         self.language_server = language_server
-        with open(self.file_path, "r") as f:
-            self.file_content = f.read()
+        # Seconds spent in each step of the helper, for the row's instrumentation
+        self.timings: Dict[str, float] = {}
+        # Files of the test state are read through the overlay, never from a modified disk
+        self.overlay = overlay
+        # Built once per document and shared with the other services
+        self.line_index = get_line_index(self.file_path, self.overlay)
+        self.file_content = self.line_index.content
 
-        self.file_lines = self.file_content.splitlines()
-        ast = get_ast(self.file_content, self.language)
+        self.file_lines = self.line_index.lines
+        ast = get_ast(self.file_content, self.language, self.file_path)
         self.tree_path = get_tree_path_at_cursor(ast, self.cursor_index)
 
-        index = point2index(self.file_content, self.cursor_index)
+        index = self.line_index.point_to_index(self.cursor_index)
         self.full_prefix = self.file_content[:index]
         self.full_suffix = suffix if suffix else self.file_content[index:]
         # print("Helper suffix")
@@ -66,31 +78,58 @@ class Helper:
         max_prefix_tokens = (
             self.options.max_prompt_tokens * self.options.prefix_percentage
         )
+        start = time.perf_counter()
         pruned_prefix = self.prune_lines_from_top(self.full_prefix, max_prefix_tokens)
+        self.timings["prune_prefix"] = time.perf_counter() - start
         max_suffix_tokens = min(
             self.options.max_prompt_tokens - count_tokens(pruned_prefix),
             self.options.max_suffix_percentage * self.options.max_prompt_tokens,
         )
+        start = time.perf_counter()
         pruned_suffix = self.prune_lines_from_bottom(
             self.full_suffix, max_suffix_tokens
         )
+        self.timings["prune_suffix"] = time.perf_counter() - start
 
         return pruned_prefix, pruned_suffix
 
+    @staticmethod
+    def _num_lines_to_prune(total_tokens: int, line_tokens, max_tokens: int) -> int:
+        """Fewest lines, taken in order from `line_tokens`, to remove so that the
+        remaining count is at most `max_tokens`, found on the cumulative counts"""
+        removed_tokens = list(itertools.accumulate(line_tokens, initial=0))
+        return min(
+            bisect.bisect_left(removed_tokens, total_tokens - max_tokens),
+            len(removed_tokens) - 1,
+        )
+
     @staticmethod
     def prune_lines_from_top(text: str, max_tokens: int):
-        total_tokens = count_tokens(text)
+        token_counter = get_token_counter()
         lines = text.splitlines()
-        while total_tokens > max_tokens and lines:
-            removed_line = lines.pop(0)
-            total_tokens -= count_tokens(removed_line)
-        return "\n".join(lines)
+        if token_counter.fits(text, max_tokens):
+            return "\n".join(lines)
+        num_pruned = Helper._num_lines_to_prune(
+            token_counter.count(text), token_counter.count_batch(lines), max_tokens
+        )
+        # Estimated cuts are checked on the kept text, exactly when close to the budget
+        while token_counter.estimated and num_pruned < len(lines) and not token_counter.fits(
+            "\n".join(lines[num_pruned:]), max_tokens
+        ):
+            num_pruned += 1
+        return "\n".join(lines[num_pruned:])
 
     @staticmethod
     def prune_lines_from_bottom(text: str, max_tokens: int):
-        total_tokens = count_tokens(text)
+        token_counter = get_token_counter()
         lines = text.splitlines()
-        while total_tokens > max_tokens and lines:
-            removed_line = lines.pop()
-            total_tokens -= count_tokens(removed_line)
-        return "\n".join(lines)
+        if token_counter.fits(text, max_tokens):
+            return "\n".join(lines)
+        num_pruned = Helper._num_lines_to_prune(
+            token_counter.count(text), reversed(token_counter.count_batch(lines)), max_tokens
+        )
+        while token_counter.estimated and num_pruned < len(lines) and not token_counter.fits(
+            "\n".join(lines[: len(lines) - num_pruned]), max_tokens
+        ):
+            num_pruned += 1
+        return "\n".join(lines[: len(lines) - num_pruned])
@@ -19,6 +19,7 @@ from pydantic import BaseModel
 from tree_sitter import Point
 
 from helper import Helper
+from overlay import DocumentOverlay
 from prompt_construction import get_all_snippets, render_prompt
 
 multilspy_logger = MultilspyLogger()
@@ -66,14 +67,11 @@ class PromptBuilder:
         self.only = only
 
     def setup_test_state(self, test_case):
-        root_path = os.path.join(self.repos_storage, test_case["encode"])
+        root_path = os.path.abspath(os.path.join(self.repos_storage, test_case["encode"]))
         file_path = os.path.join(root_path, test_case["metadata"]["file"])
-        with open(file_path, "r") as f:
-            orig_file_content = f.read()
-
+        # The modified file only lives in memory, the repository on disk is left untouched
         new_file_content = test_case["prompt"] + test_case["right_context"]
-        with open(file_path, "w") as f:
-            f.write(new_file_content)
+        overlay = DocumentOverlay({file_path: new_file_content})
         row = len(test_case["prompt"].splitlines()) - 1
         col = len(test_case["prompt"].splitlines()[-1])
         cursor_index = Point(row=row, column=col)
@@ -82,14 +80,14 @@ class PromptBuilder:
         language_server = SyncLanguageServer.create(
             config, multilspy_logger, repository_root_path=root_path, 
         )
-        return file_path, orig_file_content, cursor_index, language_server
+        return file_path, overlay, cursor_index, language_server
 
     def build_prompt(self):
         outputs = []
         for idx, row in tqdm(
             self.df.iterrows(), total=len(self.df), desc="Building prompt"
         ):
-            file_path, orig_file_content, cursor_index, language_server = (
+            file_path, overlay, cursor_index, language_server = (
                 self.setup_test_state(row)
             )
             try:
@@ -100,8 +98,10 @@ class PromptBuilder:
                     language_server=language_server,
                     language=self.language,
                     model_name=self.model_name,
+                    overlay=overlay,
                 )
                 logger.info("Helper is ready")
+                logger.info(f"Helper timings: {helper.timings}")
                 logger.info(row["encode"])
 
                 max_tries = 10
@@ -153,9 +153,6 @@ class PromptBuilder:
                 #         completion_options=None,
                 #     )
                 # )
-            finally:
-                with open(file_path, "w") as f:
-                    f.write(orig_file_content)
             logger.info("="*100)
             if len(outputs) % self.log_steps == 0:
                 self.store_df(outputs, self.log_path)
@@ -0,0 +1,158 @@
+import heapq
+import logging
+import weakref
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from chunk_index import ChunkIndex
+
+logger = logging.getLogger("inverted_index")
+
+_INVERTED_INDEXES: "weakref.WeakKeyDictionary[ChunkIndex, InvertedIndex]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+class InvertedIndex:
+    """Inverted index from token id to the chunks containing it, for exact top-k Jaccard.
+
+    Files are added and removed incrementally, removed chunks stay in the posting
+    lists as tombstones until they make up half of the index.
+    """
+
+    # Number of query tokens processed between two checks of the pruning bound
+    prune_check_steps = 8
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self.postings: Dict[int, List[int]] = defaultdict(list)
+        # chunk_id -> chunk, None once the file of the chunk is removed
+        self.chunks: List[Optional[dict]] = []
+        self.token_sets: List[Optional[frozenset]] = []
+        self.file_chunk_ids: Dict[str, List[int]] = {}
+        self.file_hashes: Dict[str, str] = {}
+        self.n_removed = 0
+
+    def __len__(self):
+        return len(self.chunks) - self.n_removed
+
+    def add_file(self, file_path: str, file_hash: str, chunks: List[dict]):
+        chunk_ids = []
+        for chunk in chunks:
+            chunk_id = len(self.chunks)
+            token_set = frozenset(chunk["encoded"])
+            self.chunks.append({**chunk, "file_path": file_path})
+            self.token_sets.append(token_set)
+            self._index_chunk(chunk_id, token_set)
+            chunk_ids.append(chunk_id)
+        self.file_chunk_ids[file_path] = chunk_ids
+        self.file_hashes[file_path] = file_hash
+
+    def _index_chunk(self, chunk_id: int, token_set: frozenset):
+        for token in token_set:
+            self.postings[token].append(chunk_id)
+
+    def remove_file(self, file_path: str):
+        for chunk_id in self.file_chunk_ids.pop(file_path, []):
+            self.chunks[chunk_id] = None
+            self.token_sets[chunk_id] = None
+            self.n_removed += 1
+        self.file_hashes.pop(file_path, None)
+
+    def sync(self, chunk_index: ChunkIndex) -> "InvertedIndex":
+        """Bring the postings up to date with the current content of `chunk_index`"""
+        records = chunk_index.file_records()
+        for file_path in self.file_hashes.keys() - records.keys():
+            self.remove_file(file_path)
+        for file_path in sorted(records):
+            record = records[file_path]
+            if self.file_hashes.get(file_path) == record["hash"]:
+                continue
+            self.remove_file(file_path)
+            self.add_file(file_path, record["hash"], record["chunks"])
+        if self.n_removed > len(self):
+            self._compact()
+        return self
+
+    def _compact(self):
+        logger.debug(f"Compact inverted index, dropping {self.n_removed} chunks")
+        files = [
+            (file_path, self.file_hashes[file_path], [self.chunks[i] for i in chunk_ids])
+            for file_path, chunk_ids in self.file_chunk_ids.items()
+        ]
+        self._reset()
+        for file_path, file_hash, chunks in files:
+            self.add_file(file_path, file_hash, chunks)
+
+    def top_k(self, query: List[int], k: int) -> List[Tuple[dict, float]]:
+        """Exact top-k chunks by Jaccard similarity of token sets with `query`.
+
+        Query tokens are processed from the rarest to the most common one. Once no
+        unseen chunk can beat the current k-th best score, only the chunks already
+        seen are scored, and those whose upper bound is below the k-th best score
+        are dropped. Ties are broken by chunk order.
+        """
+        query_set = set(query)
+        query_size = len(query_set)
+        if query_size == 0 or k <= 0:
+            return []
+        tokens = sorted(query_set, key=lambda token: len(self.postings.get(token, ())))
+        counts: Dict[int, int] = defaultdict(int)
+        token_sets = self.token_sets
+
+        def score(chunk_id: int, count: int) -> float:
+            return count / (query_size + len(token_sets[chunk_id]) - count)
+
+        def kth_best() -> float:
+            if len(counts) < k:
+                return -1.0
+            return heapq.nlargest(
+                k, (score(chunk_id, count) for chunk_id, count in counts.items())
+            )[-1]
+
+        step = 0
+        threshold = -1.0
+        for step, token in enumerate(tokens):
+            if step and step % self.prune_check_steps == 0:
+                threshold = kth_best()
+                # An unseen chunk shares at most the remaining tokens with the query
+                if (query_size - step) / query_size < threshold:
+                    break
+            for chunk_id in self.postings.get(token, ()):
+                if token_sets[chunk_id] is not None:
+                    counts[chunk_id] += 1
+        else:
+            step = len(tokens)
+
+        remaining = tokens[step:]
+        if remaining:
+            remaining_set = frozenset(remaining)
+            for chunk_id, count in list(counts.items()):
+                best_count = min(count + len(remaining), len(token_sets[chunk_id]))
+                if score(chunk_id, best_count) < threshold:
+                    del counts[chunk_id]
+                    continue
+                counts[chunk_id] = count + len(remaining_set & token_sets[chunk_id])
+
+        ranked = heapq.nsmallest(
+            k,
+            ((-score(chunk_id, count), chunk_id) for chunk_id, count in counts.items()),
+        )
+        results = [(self.chunks[chunk_id], -neg_score) for neg_score, chunk_id in ranked]
+        # Chunks sharing no token with the query score 0
+        for chunk_id, chunk in enumerate(self.chunks):
+            if len(results) >= k:
+                break
+            if chunk is not None and chunk_id not in counts:
+                results.append((chunk, 0.0))
+        return results
+
+
+def get_inverted_index(chunk_index: ChunkIndex) -> InvertedIndex:
+    inverted_index = _INVERTED_INDEXES.get(chunk_index)
+    if inverted_index is None:
+        inverted_index = InvertedIndex()
+        _INVERTED_INDEXES[chunk_index] = inverted_index
+    return inverted_index.sync(chunk_index)
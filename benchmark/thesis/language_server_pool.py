@@ -0,0 +1,172 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Set
+
+import multilspy
+from multilspy import SyncLanguageServer
+from multilspy.multilspy_config import MultilspyConfig
+from multilspy.multilspy_logger import MultilspyLogger
+
+from lsp_workspace import LSP_WORKSPACES
+from overlay import DocumentOverlay, sync_overlay_documents
+
+logger = logging.getLogger("language_server_pool")
+
+
+def _child_pids(pid: int) -> List[int]:
+    children = []
+    try:
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children", "r") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return children
+
+
+def process_tree_rss_mb(pid: int) -> float:
+    """Resident memory of a process and its descendants, 0 where /proc is not available"""
+    rss_kb = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open(f"/proc/{pid}/status", "r") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss_kb += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+        pids.extend(_child_pids(pid))
+    return rss_kb / 1024
+
+
+class PooledServer:
+    """Started server of a repository, with the overlaid documents it has open"""
+
+    def __init__(self, repo_dir: str, server: SyncLanguageServer, context):
+        self.repo_dir = repo_dir
+        self.server = server
+        # Entered `start_server()` context, exited when the server is evicted
+        self.context = context
+        self.synced: Set[str] = set()
+
+    def memory_mb(self) -> float:
+        process = self.server.language_server.server.process
+        return process_tree_rss_mb(process.pid) if process is not None else 0.0
+
+    def stop(self):
+        try:
+            self.context.__exit__(None, None, None)
+        except Exception as e:
+            logger.warning(f"Error stopping the language server of {self.repo_dir}: {e}")
+
+
+class LanguageServerPool:
+    """Warm language servers by repository, reused across rows.
+
+    The first row of a repository boots its server, the following rows only
+    push their overlaid documents with didChange. Servers are kept in LRU
+    order, the least recently used ones are shut down when more than
+    `max_servers` run or when their resident memory exceeds `max_memory_mb`.
+    Rows should be grouped by repository so that every server boots once.
+    """
+
+    def __init__(
+        self,
+        language: str,
+        max_servers: int = 1,
+        max_memory_mb: Optional[float] = None,
+        multilspy_logger: Optional[MultilspyLogger] = None,
+    ):
+        self.language = language
+        self.max_servers = max_servers
+        self.max_memory_mb = max_memory_mb
+        self.multilspy_logger = multilspy_logger or MultilspyLogger()
+        self.servers: "OrderedDict[str, PooledServer]" = OrderedDict()
+        self.starts = 0
+        self.reuses = 0
+        self.evictions = 0
+        self.start_time = 0.0
+
+    def _start(self, repo_dir: str) -> PooledServer:
+        start = time.time()
+        server = SyncLanguageServer.create(
+            MultilspyConfig.from_dict({"code_language": self.language}),
+            self.multilspy_logger,
+            repository_root_path=repo_dir,
+        )
+        context = LSP_WORKSPACES.start_server(server, repo_dir, self.language)
+        context.__enter__()
+        elapsed = time.time() - start
+        self.starts += 1
+        self.start_time += elapsed
+        logger.info(f"Started the language server of {repo_dir} in {elapsed:.1f} s")
+        return PooledServer(repo_dir, server, context)
+
+    def _evict(self, reserve: int = 0):
+        """Shut down the least recently used servers until `reserve` more fit"""
+        while self.servers and (
+            len(self.servers) + reserve > self.max_servers
+            or (
+                self.max_memory_mb is not None
+                and len(self.servers) + reserve > 1
+                and sum(pooled.memory_mb() for pooled in self.servers.values()) > self.max_memory_mb
+            )
+        ):
+            repo_dir, pooled = self.servers.popitem(last=False)
+            logger.info(f"Evict the language server of {repo_dir}")
+            pooled.stop()
+            self.evictions += 1
+
+    def get(self, repo_dir: str) -> PooledServer:
+        repo_dir = os.path.abspath(repo_dir)
+        pooled = self.servers.get(repo_dir)
+        if pooled is None:
+            self._evict(reserve=1)
+            pooled = self._start(repo_dir)
+            self.servers[repo_dir] = pooled
+        else:
+            self.reuses += 1
+            self.servers.move_to_end(repo_dir)
+            self._evict()
+        return pooled
+
+    def discard(self, repo_dir: str):
+        pooled = self.servers.pop(os.path.abspath(repo_dir), None)
+        if pooled is not None:
+            pooled.stop()
+
+    @contextmanager
+    def session(
+        self, repo_dir: str, overlay: Optional[DocumentOverlay] = None
+    ) -> Iterator[SyncLanguageServer]:
+        """Started server of the repo that sees `overlay`, in place of `start_server()`.
+
+        A server whose request failed is shut down, the next session of its
+        repo boots a new one.
+        """
+        pooled = self.get(repo_dir)
+        pooled.synced = sync_overlay_documents(pooled.server, overlay, pooled.synced)
+        try:
+            yield pooled.server
+        except multilspy.lsp_protocol_handler.server.Error:
+            self.discard(repo_dir)
+            raise
+
+    def close(self):
+        while self.servers:
+            self.servers.popitem(last=False)[1].stop()
+
+    def stats(self) -> dict:
+        return {
+            "starts": self.starts,
+            "reuses": self.reuses,
+            "evictions": self.evictions,
+            "start_time": self.start_time,
+            "running": len(self.servers),
+        }
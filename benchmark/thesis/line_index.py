@@ -0,0 +1,100 @@
+import bisect
+import itertools
+import logging
+import os
+from collections import OrderedDict
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+from tree_sitter import Point
+
+if TYPE_CHECKING:
+    from overlay import DocumentOverlay
+
+logger = logging.getLogger("line_index")
+
+# Line indexes of the documents of the run, by absolute path
+_LINE_INDEXES: "OrderedDict[str, Tuple[Optional[tuple], LineIndex]]" = OrderedDict()
+MAX_LINE_INDEXES = 256
+
+
+class LineIndex:
+    """Line start offsets of a document, for O(1) Point to offset conversions.
+
+    Lines are those of `content.splitlines()`, every line break counting as a
+    single character, like `point2index` and `read_range_in_file`.
+    """
+
+    def __init__(self, content: str):
+        self.content = content
+        self.lines: List[str] = content.splitlines()
+        # Character offset of every line, plus the end of the last line break
+        self.line_starts = list(itertools.accumulate((len(line) + 1 for line in self.lines), initial=0))
+        self._byte_line_starts: Optional[List[int]] = None
+        self._normalized: Optional[str] = None
+
+    @property
+    def byte_line_starts(self) -> List[int]:
+        if self._byte_line_starts is None:
+            self._byte_line_starts = list(
+                itertools.accumulate(
+                    (len(line.encode("utf-8", errors="surrogatepass")) + 1 for line in self.lines),
+                    initial=0,
+                )
+            )
+        return self._byte_line_starts
+
+    @property
+    def normalized(self) -> str:
+        """Content with every line break replaced by "\\n" and a final one"""
+        if self._normalized is None:
+            self._normalized = "".join(line + "\n" for line in self.lines)
+        return self._normalized
+
+    def point_to_index(self, point: Point) -> int:
+        """Character offset of a point whose column counts characters"""
+        return self.line_starts[point.row] + point.column
+
+    def index_to_point(self, index: int) -> Point:
+        row = bisect.bisect_right(self.line_starts, index) - 1
+        return Point(row, index - self.line_starts[row])
+
+    def point_to_byte(self, point: Point) -> int:
+        """utf-8 byte offset of a tree-sitter point, whose column counts bytes"""
+        return self.byte_line_starts[point.row] + point.column
+
+    def read_range(self, range) -> str:
+        """Whole lines from the start row up to the end point, sliced without copying lines"""
+        start_row, end_row = range.start_point.row, range.end_point.row
+        content = self.normalized[self.line_starts[start_row] : self.line_starts[end_row]]
+        return content + self.lines[end_row][: range.end_point.column]
+
+
+def get_line_index(file_path: str, overlay: Optional["DocumentOverlay"] = None) -> LineIndex:
+    """Line index of a document, from the overlay if present otherwise from disk.
+
+    Indexes are built once per document content and shared by every service.
+    """
+    key = os.path.abspath(file_path)
+    cached = _LINE_INDEXES.get(key)
+    if overlay is not None and file_path in overlay:
+        content = overlay.read(file_path)
+        if cached and cached[0] is None and (
+            cached[1].content is content or cached[1].content == content
+        ):
+            _LINE_INDEXES.move_to_end(key)
+            return cached[1]
+        version = None
+    else:
+        stat = os.stat(file_path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        if cached and cached[0] == version:
+            _LINE_INDEXES.move_to_end(key)
+            return cached[1]
+        with open(file_path, "r") as f:
+            content = f.read()
+    line_index = LineIndex(content)
+    _LINE_INDEXES[key] = (version, line_index)
+    _LINE_INDEXES.move_to_end(key)
+    while len(_LINE_INDEXES) > MAX_LINE_INDEXES:
+        _LINE_INDEXES.popitem(last=False)
+    return line_index
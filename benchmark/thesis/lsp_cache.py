@@ -0,0 +1,266 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import subprocess
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from tree_sitter import Point
+
+from common_funcs import Range
+from line_index import get_line_index
+from overlay import DocumentOverlay
+
+logger = logging.getLogger("lsp_cache")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    repo TEXT NOT NULL,
+    method TEXT NOT NULL,
+    file_path TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    column INTEGER NOT NULL,
+    result TEXT NOT NULL,
+    dependencies TEXT NOT NULL,
+    lsp_time REAL NOT NULL,
+    PRIMARY KEY (repo, method, file_path, content_hash, row, column)
+)
+"""
+
+
+def repo_commit(repo_dir: str) -> str:
+    """Commit checked out in the repo, or its directory name ("owner--name--commit")"""
+    if os.path.exists(os.path.join(repo_dir, ".git")):
+        try:
+            return subprocess.run(
+                ["git", "-C", repo_dir, "rev-parse", "HEAD"],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning(f"Cannot read the commit of {repo_dir}: {e}")
+    return os.path.basename(os.path.abspath(repo_dir).rstrip(os.path.sep))
+
+
+class LspCache:
+    """Persistent goto-definition/references results, in a SQLite database.
+
+    Results are keyed by (repo commit, method, file, content hash of the file,
+    position). Every result also records the content hash of the files it
+    depends on: the files of its locations and the overlaid documents. A hit
+    whose dependencies differ from the documents of the current row, on disk or
+    in its overlay, is discarded and requested again.
+
+    Without a path the cache is disabled and every request goes to the server.
+    """
+
+    def __init__(self, cache_path: Optional[str] = None):
+        self.cache_path = cache_path
+        self._connection: Optional[sqlite3.Connection] = None
+        self._commits: Dict[str, str] = {}
+        # abspath -> (content, hash), the content of unchanged documents being the same object
+        self._hashes: Dict[str, Tuple[str, str]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.lsp_time = 0.0
+        self.saved_time = 0.0
+
+    def open(self, cache_path: str):
+        self.close()
+        self.cache_path = cache_path
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            dir_path = os.path.dirname(self.cache_path)
+            if dir_path:
+                os.makedirs(dir_path, exist_ok=True)
+            self._connection = sqlite3.connect(self.cache_path)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(SCHEMA)
+        return self._connection
+
+    def _commit(self, repo_dir: str) -> str:
+        if repo_dir not in self._commits:
+            self._commits[repo_dir] = repo_commit(repo_dir)
+        return self._commits[repo_dir]
+
+    def _hash(self, file_path: str, overlay: Optional[DocumentOverlay]) -> Optional[str]:
+        """Content hash of a document as the server sees it, None if it does not exist"""
+        try:
+            content = get_line_index(file_path, overlay).content
+        except OSError:
+            return None
+        key = os.path.abspath(file_path)
+        cached = self._hashes.get(key)
+        if cached is not None and cached[0] is content:
+            return cached[1]
+        digest = hashlib.sha1(content.encode("utf-8", errors="surrogatepass")).hexdigest()
+        self._hashes[key] = (content, digest)
+        return digest
+
+    @staticmethod
+    def _relative(repo_dir: str, file_path: str) -> str:
+        """Files of the repo relative to it, so that copies of the repo share results"""
+        relative_path = os.path.relpath(os.path.abspath(file_path), repo_dir)
+        return os.path.abspath(file_path) if relative_path.startswith("..") else relative_path
+
+    @staticmethod
+    def _encode(repo_dir: str, result: Any) -> str:
+        locations = result if isinstance(result, list) else [result] if result else []
+        encoded = [
+            {
+                "file_path": LspCache._relative(repo_dir, location["file_path"]),
+                "range": [*location["range"].start_point, *location["range"].end_point],
+            }
+            for location in locations
+        ]
+        return json.dumps(encoded if isinstance(result, list) else encoded[0] if encoded else None)
+
+    @staticmethod
+    def _decode(repo_dir: str, result: str) -> Any:
+        def location(encoded: dict) -> dict:
+            start_row, start_column, end_row, end_column = encoded["range"]
+            return {
+                "file_path": os.path.join(repo_dir, encoded["file_path"]),
+                "range": Range(Point(start_row, start_column), Point(end_row, end_column)),
+            }
+
+        decoded = json.loads(result)
+        if isinstance(decoded, list):
+            return [location(encoded) for encoded in decoded]
+        return location(decoded) if decoded else None
+
+    def _dependencies(
+        self, repo_dir: str, result: Any, overlay: Optional[DocumentOverlay]
+    ) -> Dict[str, Optional[str]]:
+        locations = result if isinstance(result, list) else [result] if result else []
+        file_paths = {location["file_path"] for location in locations}
+        file_paths.update(file_path for file_path, _ in (overlay.items() if overlay else []))
+        return {
+            self._relative(repo_dir, file_path): self._hash(file_path, overlay)
+            for file_path in file_paths
+            # Files outside the repo (JDK, dependencies) do not change between rows
+            if not os.path.isabs(self._relative(repo_dir, file_path))
+        }
+
+    def _is_valid(
+        self, repo_dir: str, dependencies: Dict[str, Optional[str]], overlay: Optional[DocumentOverlay]
+    ) -> bool:
+        for file_path, _ in overlay.items() if overlay else []:
+            if self._relative(repo_dir, file_path) not in dependencies:
+                # The result was requested with this document as it is on disk
+                return False
+        return all(
+            self._hash(os.path.join(repo_dir, file_path), overlay) == digest
+            for file_path, digest in dependencies.items()
+        )
+
+    def _key(self, method: str, repo_dir: str, file_path: str, position: Point, overlay) -> tuple:
+        return (
+            self._commit(repo_dir),
+            method,
+            self._relative(repo_dir, file_path),
+            self._hash(file_path, overlay) or "",
+            position.row,
+            position.column,
+        )
+
+    def lookup(
+        self,
+        method: str,
+        repo_dir: str,
+        file_path: str,
+        position: Point,
+        overlay: Optional[DocumentOverlay],
+    ) -> Tuple[bool, Any]:
+        """(whether a valid result is cached, the result)"""
+        if not self.cache_path:
+            return False, None
+        repo_dir = os.path.abspath(repo_dir)
+        row = self.connection.execute(
+            "SELECT result, dependencies, lsp_time FROM results WHERE repo = ? AND method = ? "
+            "AND file_path = ? AND content_hash = ? AND row = ? AND column = ?",
+            self._key(method, repo_dir, file_path, position, overlay),
+        ).fetchone()
+        if row is not None:
+            result, dependencies, lsp_time = row
+            if self._is_valid(repo_dir, json.loads(dependencies), overlay):
+                self.hits += 1
+                self.saved_time += lsp_time
+                return True, self._decode(repo_dir, result)
+            self.invalidations += 1
+        self.misses += 1
+        return False, None
+
+    def store(
+        self,
+        method: str,
+        repo_dir: str,
+        file_path: str,
+        position: Point,
+        overlay: Optional[DocumentOverlay],
+        result: Any,
+        lsp_time: float,
+    ):
+        if not self.cache_path:
+            return
+        repo_dir = os.path.abspath(repo_dir)
+        self.lsp_time += lsp_time
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    *self._key(method, repo_dir, file_path, position, overlay),
+                    self._encode(repo_dir, result),
+                    json.dumps(self._dependencies(repo_dir, result, overlay)),
+                    lsp_time,
+                ),
+            )
+
+    def request(
+        self,
+        method: str,
+        repo_dir: str,
+        file_path: str,
+        position: Point,
+        overlay: Optional[DocumentOverlay],
+        send_request: Callable[[], Any],
+    ) -> Any:
+        """Result of `send_request` for `method` at `position` in `file_path`, from the cache if valid"""
+        if not self.cache_path:
+            return send_request()
+        hit, result = self.lookup(method, repo_dir, file_path, position, overlay)
+        if hit:
+            return result
+        start = time.time()
+        result = send_request()
+        self.store(method, repo_dir, file_path, position, overlay, result, time.time() - start)
+        return result
+
+    def stats(self) -> dict:
+        """Hit/miss counters, with the language server time the hits saved"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "lsp_time": self.lsp_time,
+            "saved_time": self.saved_time,
+        }
+
+
+# Shared by every language server request of the process, disabled until opened
+LSP_CACHE = LspCache()
@@ -0,0 +1,170 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+
+from multilspy import SyncLanguageServer
+from multilspy.multilspy_settings import MultilspySettings
+
+from lsp_cache import repo_commit
+
+logger = logging.getLogger("lsp_workspace")
+
+# Launch options of the servers that keep their project index in a workspace
+# directory, which multilspy sets to a new directory for every server
+WORKSPACE_OPTIONS = {
+    "java": {
+        "data": "-data",
+        "configuration": "-configuration",
+        # Parent of the throwaway workspaces, in the language server directory of multilspy
+        "throwaway_root": os.path.join("EclipseJDTLS", "workspaces"),
+    },
+}
+READY_MARKER = ".ready"
+
+
+def _is_under(path: str, dir_path: str) -> bool:
+    path, dir_path = os.path.abspath(path), os.path.abspath(dir_path)
+    return os.path.commonpath([path, dir_path]) == dir_path
+
+
+def _replace_option(cmd: List[str], option: str, value: str) -> Optional[str]:
+    """Replace the value of `option` in `cmd`, returning the previous one"""
+    if option not in cmd[:-1]:
+        return None
+    index = cmd.index(option) + 1
+    previous, cmd[index] = cmd[index], value
+    return previous
+
+
+class LspWorkspaces:
+    """Persistent language server workspaces, one by repository commit.
+
+    multilspy starts Eclipse JDTLS in a throwaway workspace directory, so every
+    server imports and indexes the project again. With a root directory, the
+    servers of a repo commit share `<root>/<language>/<commit>-<path hash>`
+    across rows, runs and the build_prompt.py/refine.py stages: once the
+    project was imported in it, a server only refreshes it on start.
+
+    A workspace is locked while a server runs in it. A server started while
+    its workspace is locked by another process falls back to the throwaway
+    directory of multilspy. Every start is timed as cold (new workspace) or
+    warm, and appended to `starts.jsonl` in the workspace.
+
+    Without a root directory servers start as before, and are only timed.
+    """
+
+    def __init__(self, root_dir: Optional[str] = None):
+        self.root_dir = root_dir
+        self.cold_starts = 0
+        self.warm_starts = 0
+        self.cold_time = 0.0
+        self.warm_time = 0.0
+
+    def open(self, root_dir: str):
+        self.root_dir = root_dir
+
+    def workspace_dir(self, repo_dir: str, language: str) -> str:
+        repo_dir = os.path.abspath(repo_dir)
+        # The project location is recorded in the workspace, so copies of a repo do not share it
+        path_hash = hashlib.sha1(repo_dir.encode("utf-8")).hexdigest()[:8]
+        return os.path.join(self.root_dir, language, f"{repo_commit(repo_dir)}-{path_hash}")
+
+    @staticmethod
+    def _lock(workspace_dir: str):
+        lock_file = open(os.path.join(workspace_dir, "lock"), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def _use_workspace(self, server: SyncLanguageServer, workspace_dir: str, options: dict):
+        """Point the launch command of a not yet started server to `workspace_dir`"""
+        launch_info = server.language_server.server.process_launch_info
+        cmd = launch_info.cmd.split(" ")
+        data_dir = os.path.join(workspace_dir, "data_dir")
+        config_dir = os.path.join(workspace_dir, "config_path")
+        throwaway_config_dir = _replace_option(cmd, options["configuration"], config_dir)
+        throwaway_data_dir = _replace_option(cmd, options["data"], data_dir)
+        if throwaway_config_dir is None or throwaway_data_dir is None:
+            logger.warning(f"Unexpected launch command of the language server: {launch_info.cmd}")
+            return
+        if throwaway_data_dir == data_dir:
+            # Started again, e.g. by a retry, already in the workspace
+            return
+        if not os.path.exists(config_dir):
+            shutil.copytree(throwaway_config_dir, config_dir)
+        launch_info.cmd = " ".join(cmd)
+        throwaway_dir = os.path.dirname(throwaway_data_dir)
+        throwaway_root = os.path.join(
+            MultilspySettings.get_language_server_directory(), options["throwaway_root"]
+        )
+        # Only the new directory of multilspy, never a persistent workspace
+        if _is_under(throwaway_dir, throwaway_root) and not _is_under(throwaway_dir, self.root_dir):
+            shutil.rmtree(throwaway_dir, ignore_errors=True)
+
+    def _record(self, workspace_dir: Optional[str], warm: bool, elapsed: float):
+        if warm:
+            self.warm_starts += 1
+            self.warm_time += elapsed
+        else:
+            self.cold_starts += 1
+            self.cold_time += elapsed
+        logger.info(f"{'Warm' if warm else 'Cold'} language server start in {elapsed:.1f} s")
+        if workspace_dir is None:
+            return
+        with open(os.path.join(workspace_dir, "starts.jsonl"), "a") as f:
+            stage = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+            f.write(json.dumps({"stage": stage, "warm": warm, "seconds": elapsed, "time": time.time()}) + "\n")
+
+    @contextmanager
+    def start_server(
+        self, server: SyncLanguageServer, repo_dir: str, language: str
+    ) -> Iterator[SyncLanguageServer]:
+        """`server.start_server()`, in the persistent workspace of the repo if enabled"""
+        workspace_dir, lock_file = None, None
+        options = WORKSPACE_OPTIONS.get(language)
+        if self.root_dir and options is not None:
+            workspace_dir = self.workspace_dir(repo_dir, language)
+            os.makedirs(workspace_dir, exist_ok=True)
+            lock_file = self._lock(workspace_dir)
+            if lock_file is None:
+                logger.warning(f"{workspace_dir} is in use, start in a throwaway workspace")
+                workspace_dir = None
+            else:
+                self._use_workspace(server, workspace_dir, options)
+        try:
+            warm = workspace_dir is not None and os.path.exists(
+                os.path.join(workspace_dir, READY_MARKER)
+            )
+            start = time.time()
+            with server.start_server():
+                self._record(workspace_dir, warm, time.time() - start)
+                if workspace_dir is not None and not warm:
+                    # The project is imported, following servers reuse it
+                    open(os.path.join(workspace_dir, READY_MARKER), "w").close()
+                yield server
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+
+    def stats(self) -> dict:
+        """Number and total seconds of the cold and warm starts"""
+        return {
+            "cold_starts": self.cold_starts,
+            "warm_starts": self.warm_starts,
+            "cold_time": self.cold_time,
+            "warm_time": self.warm_time,
+        }
+
+
+# Shared by every language server of the process, throwaway workspaces until opened
+LSP_WORKSPACES = LspWorkspaces()
@@ -0,0 +1,114 @@
+import heapq
+import logging
+import time
+import weakref
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from chunk_index import ChunkIndex
+from inverted_index import InvertedIndex
+
+logger = logging.getLogger("minhash")
+
+MERSENNE_PRIME = (1 << 31) - 1
+
+_LSH_INDEXES: "weakref.WeakKeyDictionary[ChunkIndex, Dict[tuple, MinHashLSH]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+class MinHashLSH(InvertedIndex):
+    """Approximate top-k Jaccard retrieval with MinHash signatures and an LSH band table.
+
+    Chunks sharing at least one band of their signature with the query are
+    re-ranked with their exact Jaccard similarity. More bands raise recall, more
+    rows per band make buckets more selective: two token sets of similarity s
+    become candidates with probability 1 - (1 - s ** rows) ** bands.
+
+    The token postings of the exact index are kept along with the band table:
+    when fewer than k chunks are candidates, typically for queries of rare
+    tokens, the exact top-k fills the missing results. `fallbacks` and
+    `fallback_time` count these queries and the seconds spent on them.
+    """
+
+    def __init__(self, num_bands: int = 32, rows_per_band: int = 2, seed: int = 1):
+        self.num_bands = num_bands
+        self.rows_per_band = rows_per_band
+        rng = np.random.default_rng(seed)
+        num_perm = num_bands * rows_per_band
+        self.hash_a = rng.integers(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.hash_b = rng.integers(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.fallbacks = 0
+        self.fallback_time = 0.0
+        super().__init__()
+
+    def _reset(self):
+        super()._reset()
+        self.bands: Dict[Tuple[int, bytes], List[int]] = defaultdict(list)
+
+    def signature(self, token_set) -> np.ndarray:
+        tokens = np.fromiter(token_set, dtype=np.uint64, count=len(token_set))
+        tokens %= MERSENNE_PRIME
+        hashes = (np.outer(self.hash_a, tokens) + self.hash_b[:, None]) % MERSENNE_PRIME
+        return hashes.min(axis=1)
+
+    def band_keys(self, token_set) -> List[Tuple[int, bytes]]:
+        signature = self.signature(token_set).reshape(self.num_bands, self.rows_per_band)
+        return [(band, signature[band].tobytes()) for band in range(self.num_bands)]
+
+    def _index_chunk(self, chunk_id: int, token_set: frozenset):
+        super()._index_chunk(chunk_id, token_set)
+        if not token_set:
+            return
+        for key in self.band_keys(token_set):
+            self.bands[key].append(chunk_id)
+
+    def top_k(self, query: List[int], k: int) -> List[Tuple[dict, float]]:
+        query_set = frozenset(query)
+        if not query_set or k <= 0:
+            return []
+        candidates = set()
+        for key in self.band_keys(query_set):
+            candidates.update(self.bands.get(key, ()))
+
+        def score(chunk_id: int) -> float:
+            token_set = self.token_sets[chunk_id]
+            intersection = len(query_set & token_set)
+            return intersection / (len(query_set) + len(token_set) - intersection)
+
+        ranked = heapq.nsmallest(
+            k,
+            (
+                (-score(chunk_id), chunk_id)
+                for chunk_id in candidates
+                if self.token_sets[chunk_id] is not None
+            ),
+        )
+        results = [(self.chunks[chunk_id], -neg_score) for neg_score, chunk_id in ranked]
+        if len(results) < k:
+            logger.debug(f"{len(results)} LSH candidates for top {k}, filled from the exact index")
+            start = time.perf_counter()
+            seen = {id(chunk) for chunk, _ in results}
+            results.extend(
+                (chunk, chunk_score)
+                for chunk, chunk_score in super().top_k(query, k)
+                if id(chunk) not in seen
+            )
+            # Stable, the LSH candidates come first among ties
+            results = sorted(results, key=lambda item: -item[1])[:k]
+            self.fallbacks += 1
+            self.fallback_time += time.perf_counter() - start
+        return results
+
+
+def get_lsh_index(
+    chunk_index: ChunkIndex, num_bands: int = 32, rows_per_band: int = 2
+) -> MinHashLSH:
+    lsh_indexes = _LSH_INDEXES.setdefault(chunk_index, {})
+    lsh_index = lsh_indexes.get((num_bands, rows_per_band))
+    if lsh_index is None:
+        lsh_index = MinHashLSH(num_bands, rows_per_band)
+        lsh_indexes[(num_bands, rows_per_band)] = lsh_index
+    return lsh_index.sync(chunk_index)
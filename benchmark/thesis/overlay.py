@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import os
+import pathlib
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional, Set, TypeVar
+
+from multilspy.language_server import LSPFileBuffer
+from multilspy.lsp_protocol_handler.lsp_constants import LSPConstants
+
+logger = logging.getLogger("overlay")
+
+T = TypeVar("T")
+
+
+class DocumentOverlay:
+    """In-memory path -> content overlay over the repository on disk.
+
+    Modified test-state files are never written to disk, so a crash cannot leave
+    a repository corrupted and rows of the same repository do not contend for it.
+    """
+
+    def __init__(self, documents: Optional[Dict[str, str]] = None):
+        self.documents: Dict[str, str] = {}
+        for file_path, content in (documents or {}).items():
+            self.set(file_path, content)
+
+    @staticmethod
+    def _key(file_path: str) -> str:
+        return os.path.abspath(file_path)
+
+    def set(self, file_path: str, content: str):
+        self.documents[self._key(file_path)] = content
+
+    def discard(self, file_path: str):
+        self.documents.pop(self._key(file_path), None)
+
+    def __contains__(self, file_path: str) -> bool:
+        return self._key(file_path) in self.documents
+
+    def items(self):
+        return self.documents.items()
+
+    def read(self, file_path: str) -> str:
+        """Content of the file, from the overlay if present otherwise from disk"""
+        content = self.documents.get(self._key(file_path))
+        if content is not None:
+            return content
+        with open(file_path, "r") as f:
+            return f.read()
+
+
+def read_document(file_path: str, overlay: Optional[DocumentOverlay] = None) -> str:
+    if overlay is not None:
+        return overlay.read(file_path)
+    with open(file_path, "r") as f:
+        return f.read()
+
+
+def _run_on_server_loop(language_server, update: Callable[[], T]) -> T:
+    """Run `update` in the event loop thread of a started `SyncLanguageServer`.
+
+    Notifications write to the server process through an asyncio stream of
+    that loop, and its requests use the open documents, so both are only
+    touched from there.
+    """
+
+    async def run() -> T:
+        return update()
+
+    return asyncio.run_coroutine_threadsafe(run(), language_server.loop).result()
+
+
+def _acquire_document(server, uri: str, content: str, references: int = 1):
+    """Open `uri` with `content` (didOpen), or make the open document hold it (didChange).
+
+    `references` are added to the reference count of the document, as the
+    `open_file` of multilspy does, so that its requests do not close it.
+    """
+    file_buffer = server.open_file_buffers.get(uri)
+    if file_buffer is None:
+        server.open_file_buffers[uri] = LSPFileBuffer(uri, content, 0, server.language_id, references)
+        server.server.notify.did_open_text_document(
+            {
+                LSPConstants.TEXT_DOCUMENT: {
+                    LSPConstants.URI: uri,
+                    LSPConstants.LANGUAGE_ID: server.language_id,
+                    LSPConstants.VERSION: 0,
+                    LSPConstants.TEXT: content,
+                }
+            }
+        )
+        return
+    file_buffer.ref_count += references
+    if file_buffer.contents == content:
+        return
+    file_buffer.version += 1
+    file_buffer.contents = content
+    # Full content change, without a range
+    server.server.notify.did_change_text_document(
+        {
+            LSPConstants.TEXT_DOCUMENT: {
+                LSPConstants.VERSION: file_buffer.version,
+                LSPConstants.URI: uri,
+            },
+            LSPConstants.CONTENT_CHANGES: [{LSPConstants.TEXT: content}],
+        }
+    )
+
+
+def release_document(server, uri: str):
+    """Drop a reference to `uri`, closing it (didClose) when it was the last one.
+
+    Only called from the event loop of the server.
+    """
+    file_buffer = server.open_file_buffers.get(uri)
+    if file_buffer is None:
+        return
+    file_buffer.ref_count -= 1
+    if file_buffer.ref_count <= 0:
+        server.server.notify.did_close_text_document(
+            {LSPConstants.TEXT_DOCUMENT: {LSPConstants.URI: uri}}
+        )
+        del server.open_file_buffers[uri]
+
+
+def _overlay_uris(overlay: Optional[DocumentOverlay]) -> Dict[str, str]:
+    return {
+        pathlib.Path(file_path).as_uri(): content
+        for file_path, content in (overlay.items() if overlay is not None else [])
+    }
+
+
+@contextmanager
+def open_overlay_documents(language_server, overlay: Optional[DocumentOverlay]) -> Iterator[None]:
+    """Make a started language server see the overlaid documents.
+
+    Requests on these files then see the overlaid content instead of the file
+    on disk, until the documents are closed on exit.
+    """
+    documents = _overlay_uris(overlay)
+    if not documents:
+        yield
+        return
+    server = language_server.language_server
+
+    def acquire():
+        for uri, content in documents.items():
+            _acquire_document(server, uri, content)
+
+    def release():
+        for uri in documents:
+            release_document(server, uri)
+
+    _run_on_server_loop(language_server, acquire)
+    try:
+        yield
+    finally:
+        _run_on_server_loop(language_server, release)
+
+
+def sync_overlay_documents(
+    language_server, overlay: Optional[DocumentOverlay], synced: Set[str]
+) -> Set[str]:
+    """Make a started server see `overlay`, and the files on disk for the others.
+
+    For servers reused across rows, whose overlaid documents stay open between
+    rows. `synced` are the URIs overlaid by the previous call: those still
+    overlaid are updated with didChange, the others are closed so that the
+    server reads them from disk again. Returns the URIs now overlaid.
+    """
+    server = language_server.language_server
+    documents = _overlay_uris(overlay)
+
+    def sync():
+        for uri in synced - documents.keys():
+            release_document(server, uri)
+        for uri, content in documents.items():
+            _acquire_document(server, uri, content, references=0 if uri in synced else 1)
+
+    _run_on_server_loop(language_server, sync)
+    return set(documents)
@@ -0,0 +1,113 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Tuple
+
+from tree_sitter import Parser, Point, Tree
+
+logger = logging.getLogger("parse_cache")
+
+
+class SourceEdit(NamedTuple):
+    start_byte: int
+    old_end_byte: int
+    new_end_byte: int
+
+
+def _common_prefix_length(a: memoryview, b: memoryview) -> int:
+    """Length of the common prefix, by binary search on memcmp'd slices"""
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def diff_sources(old: bytes, new: bytes) -> SourceEdit:
+    """Single edit turning `old` into `new`: everything but their common prefix and suffix"""
+    old_view, new_view = memoryview(old), memoryview(new)
+    prefix = _common_prefix_length(old_view, new_view)
+    max_suffix = min(len(old), len(new)) - prefix
+    low, high = 0, max_suffix
+    while low < high:
+        middle = (low + high + 1) // 2
+        if old_view[len(old) - middle :] == new_view[len(new) - middle :]:
+            low = middle
+        else:
+            high = middle - 1
+    return SourceEdit(prefix, len(old) - low, len(new) - low)
+
+
+def byte_point(source: bytes, byte: int) -> Point:
+    row = source.count(b"\n", 0, byte)
+    return Point(row, byte - (source.rfind(b"\n", 0, byte) + 1))
+
+
+class ParseCache:
+    """Parse trees of the documents of a run, keyed by file and content hash.
+
+    A document whose content is unchanged gets its tree back. When its content
+    changed, the previous tree is edited over the changed region and the new
+    content is reparsed incrementally, so each file is fully parsed once as long
+    as it stays in the cache. Documents without a path are only reused when
+    their content is identical.
+    """
+
+    def __init__(self, max_size: int = 512):
+        self.max_size = max_size
+        # (file_path or content hash, language) -> (source, content hash, tree)
+        self.entries: "OrderedDict[Tuple[str, str], Tuple[bytes, str, Tree]]" = OrderedDict()
+        self.hits = 0
+        self.incremental_parses = 0
+        self.full_parses = 0
+
+    def parse(
+        self, parser: Parser, content: str, language: str, file_path: Optional[str] = None
+    ) -> Tree:
+        source = bytes(content, encoding="utf-8")
+        digest = hashlib.sha1(source).hexdigest()
+        key = (file_path or digest, language)
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] == digest:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[2]
+
+        if entry is not None:
+            old_source, _, old_tree = entry
+            edit = diff_sources(old_source, source)
+            # Trees handed out before stay valid, only the copy is edited
+            edited_tree = old_tree.copy()
+            edited_tree.edit(
+                start_byte=edit.start_byte,
+                old_end_byte=edit.old_end_byte,
+                new_end_byte=edit.new_end_byte,
+                start_point=byte_point(old_source, edit.start_byte),
+                old_end_point=byte_point(old_source, edit.old_end_byte),
+                new_end_point=byte_point(source, edit.new_end_byte),
+            )
+            tree = parser.parse(source, edited_tree)
+            self.incremental_parses += 1
+        else:
+            tree = parser.parse(source)
+            self.full_parses += 1
+
+        self.entries[key] = (source, digest, tree)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return tree
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "incremental_parses": self.incremental_parses,
+            "full_parses": self.full_parses,
+        }
+
+
+# Shared by every parse of the process
+PARSE_CACHE = ParseCache()
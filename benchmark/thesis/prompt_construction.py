@@ -1,12 +1,15 @@
 from helper import Helper
-from typing import List, Tuple, TypeVar
+from typing import List, Optional, Tuple, TypeVar
 from similar_usage import SimilarUsageService
 from similar_code import SimilarCodeService
+from line_index import get_line_index
+from common_funcs import Range
 import os
 import sys
 
 CWD = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(CWD)
+CHUNKED_DIR = os.path.join(CWD, "..", "..", "data", "chunked")
 
 from utils import (
     get_window_around_cursor,
@@ -22,26 +25,73 @@ from utils import (
 import logging
 logger = logging.getLogger("prompt_construction")
 Snippet = TypeVar("Snippet")
+# Carried along with the snippets for ranking and budget packing only
+SNIPPET_TOKEN_KEYS = ("encoded", "token_count")
+
+
+def get_all_snippets(
+    helper: Helper,
+    similar_code_service: Optional[SimilarCodeService] = None,
+    similar_code_snippets: Optional[List[Snippet]] = None,
+    similar_usage: bool = False,
+    similar_usage_backend: str = "lsp",
+    concurrent_lsp: bool = False,
+) -> Tuple[List[Snippet]]:
+    """`similar_code_snippets` already retrieved for the helper's cursor are reused as is.
+
+    Similar usages are only retrieved with `similar_usage`, see
+    `get_similar_usage_snippets` for `similar_usage_backend` and `concurrent_lsp`.
+    """
+    similar_usage_snippets = (
+        get_similar_usage_snippets(helper, similar_usage_backend, concurrent_lsp)
+        if similar_usage
+        else []
+    )
+    if similar_code_snippets is None:
+        similar_code_snippets = get_similar_code_snippets(helper, similar_code_service)
+    return similar_usage_snippets, similar_code_snippets
+
+
+def snippet_for_output(snippet: Snippet, range_as_json: bool = False) -> Snippet:
+    """Snippet without the token ids and its `Range` converted for a `BuilderOutput`"""
+    output = {key: value for key, value in snippet.items() if key not in SNIPPET_TOKEN_KEYS}
+    if isinstance(output.get("range"), Range):
+        output["range"] = output["range"].to_json() if range_as_json else output["range"].to_irange()
+    return output
 
 
-def get_all_snippets(helper: Helper) -> Tuple[List[Snippet]]:
-    # similar_usage_snippets = get_similar_usage_snippets(helper)
-    similar_code_snippets = get_similar_code_snippets(helper)
-    # return similar_usage_snippets, similar_code_snippets
-    return [], similar_code_snippets
+def strip_snippet_tokens(snippet_payload: Tuple[List[Snippet]]) -> Tuple[List[Snippet]]:
+    """Snippet payload as stored in the outputs.
 
+    Similar usage ranges are written as `IRange` models and similar code ranges
+    as their JSON string, like the chunks always stored them.
+    """
+    similar_usage_snippets, similar_code_snippets = snippet_payload
+    return (
+        [snippet_for_output(snippet) for snippet in similar_usage_snippets],
+        [snippet_for_output(snippet, range_as_json=True) for snippet in similar_code_snippets],
+    )
 
-def get_similar_code_snippets(helper: Helper) -> List[Snippet]:
-    similar_code_service = SimilarCodeService(cached_dir=os.path.join(CWD, "..", "..", "data", "chunked"))
+
+def get_similar_code_snippets(
+    helper: Helper, similar_code_service: Optional[SimilarCodeService] = None
+) -> List[Snippet]:
+    if similar_code_service is None:
+        similar_code_service = SimilarCodeService(cached_dir=CHUNKED_DIR)
     similar_code_snippets = similar_code_service.get_similar_code(helper)
     return similar_code_snippets
 
 
-def get_similar_usage_snippets(helper: Helper) -> List[Snippet]:
+def get_similar_usage_snippets(
+    helper: Helper, backend: str = "lsp", concurrent: bool = False
+) -> List[Snippet]:
     similar_usage_service = SimilarUsageService(
         repo_dir=helper.repo_dir,
         language_server=helper.language_server,
         language=helper.language,
+        overlay=helper.overlay,
+        backend=backend,
+        concurrent=concurrent,
     )
 
     similar_usages = similar_usage_service.get_similar_usages(
@@ -55,8 +105,9 @@ def get_similar_usage_snippets(helper: Helper) -> List[Snippet]:
     logger.debug(f"Similar usages:\n{similar_usages}")
     for usage in similar_usages:
         cursor = usage["range"].start_point
-        with open(usage["file_path"], "r") as f:
-            file_lines = f.readlines()
+        file_lines = get_line_index(usage["file_path"], helper.overlay).content.splitlines(
+            keepends=True
+        )
         content = get_window_around_cursor(cursor, file_lines, window_size=128)
         similar_usage_snippets.append({
             "file_path": usage["file_path"],
@@ -96,7 +147,10 @@ def get_snippets(
         snippet = ranked_snippets.pop(0)
         if (not snippet or not is_valid_snippet(snippet)):
             continue
-        snippet_size = count_tokens(snippet["content"]) + 10
+        if "token_count" in snippet:
+            snippet_size = snippet["token_count"] + 10
+        else:
+            snippet_size = count_tokens(snippet["content"]) + 10
         if (remaining_token_count >= snippet_size):
             final_snippets.append(snippet)
             remaining_token_count -= snippet_size
@@ -1,53 +1,85 @@
 from helper import Helper
 from tree_sitter import Point
+import io
 import os
-import pandas as pd
-from typing import List
-EXTENSION = {
-    "java": ".java",
-    "python": ".py",
-}
-from utils import get_window_around_cursor, jaccard_similarity
-from common_funcs import TOKENIZER, IRange
+from typing import List, Optional
+from chunk_index import ChunkIndex, content_hash, get_chunk_index
+from inverted_index import InvertedIndex, get_inverted_index
+from minhash import get_lsh_index
+from sparse_index import get_sparse_matrix
+from utils import get_window_around_cursor
+from common_funcs import TOKENIZER, LazyTokenizer, Range
+from token_counter import TOKEN_COUNTER, TokenCounter
+
+SIMILAR_CODE_MODES = ["exact", "lsh"]
+
 
 class SimilarCodeService:
     max_chunk_size = 128
     top_k = 10
-    def __init__(self, cached_dir: str, tokenizer=TOKENIZER):
+    def __init__(
+        self,
+        cached_dir: str,
+        tokenizer=TOKENIZER,
+        mode: str = "exact",
+        lsh_bands: int = 32,
+        lsh_rows: int = 2,
+        num_workers: int = 1,
+    ):
+        """`mode` is "exact" for the inverted index or "lsh" for approximate MinHash
+        retrieval, where `lsh_bands` and `lsh_rows` trade recall for latency.
+        `num_workers` > 1 chunks changed files with a process pool."""
+        if mode not in SIMILAR_CODE_MODES:
+            raise NotImplementedError(f"Similar code mode {mode} is not supported")
         self.tokenizer = tokenizer
+        # Queries go through the shared memoized counter, so that ranking the
+        # snippets afterwards finds them already tokenized
+        self.token_counter = TOKEN_COUNTER if tokenizer is TOKENIZER else TokenCounter(tokenizer)
         self.cached_dir = cached_dir
+        self.mode = mode
+        self.lsh_bands = lsh_bands
+        self.lsh_rows = lsh_rows
+        self.num_workers = num_workers
         if not os.path.exists(cached_dir):
             os.makedirs(cached_dir)
     
+    def get_index(self, repo_dir: str, language: str) -> ChunkIndex:
+        return get_chunk_index(repo_dir, language, self.cached_dir, self._chunk_and_encode)
+
     def chunk_project(self, repo_dir: str, language: str):
-        repo_name = repo_dir.split(os.path.sep)[-1]
-        all_chunks = []
-        for subdir, dirs, files in os.walk(repo_dir):
-            for file in files:
-                if file.endswith(EXTENSION[language]):
-                    file_path = os.path.join(subdir, file)
-                    chunks = self._chunk_code(file_path)
-                    all_chunks.extend(chunks)
-        pd.DataFrame(all_chunks).to_json(os.path.join(self.cached_dir, repo_name + ".jsonl"), orient="records", lines=True)
+        """Bring the persistent chunk index of the repo up to date with the files on disk"""
+        index = self.get_index(repo_dir, language)
+        if self.num_workers > 1 and isinstance(self.tokenizer, LazyTokenizer):
+            # Loaded before the pool forks, so that the workers share it
+            self.tokenizer.load()
+        index.refresh(self.num_workers)
+        index.save()
+        return index
 
-    
-    def _chunk_code(self, file_path: str):
-        with open(file_path, "r") as f:
-            file_lines = f.readlines()
+    def _count_line_tokens(self, file_lines: List[str]) -> List[int]:
+        """Token count of every line, with one batched tokenizer call per file"""
+        if not file_lines:
+            return []
+        return [len(input_ids) for input_ids in self.tokenizer(file_lines)["input_ids"]]
+
+    def _chunk_code(self, file_path: str, content: Optional[str] = None):
+        if content is None:
+            with open(file_path, "r") as f:
+                content = f.read()
+        file_lines = io.StringIO(content).readlines()
+        line_token_counts = self._count_line_tokens(file_lines)
         chunks = []
         current_chunk = []
         current_token_count = 0
         start_line = 0
-        for i, line in enumerate(file_lines):
-            # Count tokens in the current line
-            line_tokens = len(self.tokenizer(line)["input_ids"])
+        for i, (line, line_tokens) in enumerate(zip(file_lines, line_token_counts)):
             # If this single line exceeds max_tokens, we need to handle it specially
             if line_tokens > self.max_chunk_size:
                 # If there's content in the current chunk, finalize it
                 if current_chunk:
                     chunks.append({
                         "content": "".join(current_chunk),
-                        "range": IRange(start_point=Point(start_line, 0), end_point=Point(i, 0)).model_dump_json(),
+                        "range": Range(Point(start_line, 0), Point(i, 0)),
                         "file_path": file_path
                     })
                     current_chunk = []
@@ -56,7 +88,7 @@ class SimilarCodeService:
                 # Add the large line as its own chunk, potentially truncated
                 chunks.append({
                     "content": line,
-                    "range": IRange(start_point=Point(i, 0), end_point=Point(i + 1, 0)).model_dump_json(),
+                    "range": Range(Point(i, 0), Point(i + 1, 0)),
                     "file_path": file_path
                 })
                 
@@ -67,7 +99,7 @@ class SimilarCodeService:
             elif current_token_count + line_tokens > self.max_chunk_size and current_chunk:
                 chunks.append({
                     "content": "".join(current_chunk),
-                    "range": IRange(start_point=Point(start_line, 0), end_point=Point(i, 0)).model_dump_json(),  # end at previous line
+                    "range": Range(Point(start_line, 0), Point(i, 0)),  # end at previous line
                     "file_path": file_path
                 })
                 current_chunk = [line]
@@ -82,31 +114,81 @@ class SimilarCodeService:
         if current_chunk:
             chunks.append({
                 "content": "".join(current_chunk),
-                "range": IRange(start_point=Point(start_line, 0), end_point=Point(len(file_lines), 0)).model_dump_json(),
+                "range": Range(Point(start_line, 0), Point(len(file_lines), 0)),
                 "file_path": file_path
             })
         return chunks
 
 
-    def _get_candidates(self, repo_dir: str):
-        repo_name = repo_dir.split(os.path.sep)[-1]
-        cached_file_name = repo_name + ".jsonl"
-        cached_file_path = os.path.join(self.cached_dir, cached_file_name)
-        candidates = pd.read_json(cached_file_path, lines=True)
-        return candidates
-    
+    def _chunk_and_encode(self, file_path: str, content: Optional[str] = None):
+        chunks = self._chunk_code(file_path, content)
+        if chunks:
+            encoded = self.tokenizer([chunk["content"] for chunk in chunks])["input_ids"]
+            for chunk, input_ids in zip(chunks, encoded):
+                chunk["encoded"] = input_ids
+        return chunks
+
+    def get_retriever(self, index: ChunkIndex) -> InvertedIndex:
+        if self.mode == "lsh":
+            return get_lsh_index(index, self.lsh_bands, self.lsh_rows)
+        return get_inverted_index(index)
+
+    @staticmethod
+    def _snippet(chunk: dict) -> dict:
+        """Snippet of a chunk, carrying the token ids computed when it was chunked"""
+        return {
+            "content": chunk["content"],
+            "range": chunk["range"],
+            "file_path": chunk["file_path"],
+            "encoded": chunk["encoded"],
+            "token_count": len(chunk["encoded"]),
+        }
+
     def get_similar_code(self, helper: Helper):
         query_text = get_window_around_cursor(helper.cursor_index, helper.file_lines)
-        encoded_query_text = self.tokenizer(query_text)["input_ids"]
-        with open(helper.file_path, "r") as f:
-            origin_content = f.read()
-        with open(helper.file_path, "w") as f:
-            f.write(helper.full_prefix + helper.full_suffix)
-        self.chunk_project(helper.repo_dir, helper.language)
-        candidates = self._get_candidates(helper.repo_dir)
-        candidates["encoded"] = candidates["content"].apply(lambda candidate: self.tokenizer(candidate)["input_ids"])
-        candidates["similarity"] = candidates["encoded"].apply(lambda candidate: jaccard_similarity(encoded_query_text, candidate))
-        candidates = candidates.sort_values(by="similarity", ascending=False)
-        with open(helper.file_path, "w") as f:
-            f.write(origin_content)
-        return candidates.head(self.top_k)[["content", "range", "file_path"]].to_dict(orient="records")
\ No newline at end of file
+        encoded_query_text = self.token_counter.encode(query_text)
+        index = self.chunk_project(helper.repo_dir, helper.language)
+        # Only the file under the cursor differs from the repo on disk
+        index.discard_overrides(keep=helper.file_path)
+        index.update_file(helper.file_path, helper.full_prefix + helper.full_suffix)
+        top_k = self.get_retriever(index).top_k(encoded_query_text, self.top_k)
+        return [self._snippet(chunk) for chunk, similarity in top_k]
+
+    def get_similar_code_batch(self, repo_dir: str, language: str, queries: List[dict]):
+        """Exact similar code for many cursors of the same repo at once.
+
+        Every query is a dict with the "file_path" under the cursor, its modified
+        "content" and the "cursor_index". Scores are the same as with
+        `get_similar_code` in the exact mode, chunks of equal score may come in
+        another order.
+        """
+        if self.mode != "exact":
+            raise NotImplementedError(f"Batched similar code is not supported in mode {self.mode}")
+        index = self.chunk_project(repo_dir, language)
+        query_texts = [
+            get_window_around_cursor(query["cursor_index"], query["content"].splitlines())
+            for query in queries
+        ]
+        encoded_queries = self.token_counter.encode_batch(query_texts)
+        # The file under the cursor is replaced by the chunks of its modified content
+        excluded_files = []
+        extra_chunks = []
+        modified_chunks = {}
+        for query in queries:
+            record = index.files.get(query["file_path"])
+            digest = content_hash(query["content"])
+            if record and record["hash"] == digest:
+                excluded_files.append(None)
+                extra_chunks.append([])
+                continue
+            key = (query["file_path"], digest)
+            if key not in modified_chunks:
+                modified_chunks[key] = self._chunk_and_encode(
+                    query["file_path"], query["content"]
+                )
+            excluded_files.append(query["file_path"])
+            extra_chunks.append(modified_chunks[key])
+        top_ks = get_sparse_matrix(index).top_k(
+            encoded_queries, self.top_k, excluded_files, extra_chunks
+        )
+        return [[self._snippet(chunk) for chunk, similarity in top_k] for top_k in top_ks]
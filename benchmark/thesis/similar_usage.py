@@ -1,21 +1,103 @@
+import asyncio
+import os
+import pathlib
 import time
+from contextlib import nullcontext
+from typing import List, Tuple
 
+import multilspy
 from multilspy import SyncLanguageServer
 from tree_sitter import Node, Point
 import logging
-from common_funcs import get_ast, get_tree_path_at_cursor, lsprange2irange
+from common_funcs import get_ast, get_tree_path_at_cursor, lsprange2range
+from line_index import get_line_index
+from lsp_cache import LSP_CACHE, LspCache
+from overlay import DocumentOverlay, open_overlay_documents, release_document
+from symbol_index import call_site_of, get_symbol_index
 
 logger = logging.getLogger("similar_usage")
 
+SIMILAR_USAGE_BACKENDS = ["lsp", "static"]
+USAGE_NODE_TYPES = {
+    "call_expression",  # Typescript function invocation
+    "method_invocation",  # Java method invocation
+    "call",  # Python function invocation and new class instance
+    "new_expression",  # Typescript function invocation
+    "object_creation_expression",  # Java new class instance
+}
+
+
 class SimilarUsageService:
     def __init__(
-        self, repo_dir: str, language_server: SyncLanguageServer, language: str = "java"
+        self,
+        repo_dir: str,
+        language_server: SyncLanguageServer | None,
+        language: str = "java",
+        overlay: DocumentOverlay | None = None,
+        backend: str = "lsp",
+        lsp_cache: LspCache = LSP_CACHE,
+        concurrent: bool = False,
+        request_timeout: float = 30.0,
     ):
+        """`backend` is "lsp" to ask the language server, or "static" to answer from
+        the tree-sitter `SymbolIndex` of the repo. With "static", the language
+        server, if any, is only asked about calls the index cannot resolve to a
+        single definition. Language server results go through `lsp_cache`.
+        With `concurrent`, the requests of all call nodes on the cursor path are
+        in flight together, each one given up after `request_timeout` seconds."""
+        if backend not in SIMILAR_USAGE_BACKENDS:
+            raise NotImplementedError(f"Similar usage backend {backend} is not supported")
         self.repo_dir = repo_dir
         self.language_server = language_server
         self.language = language
+        self.overlay = overlay
+        self.backend = backend
+        self.lsp_cache = lsp_cache
+        self.concurrent = concurrent
+        self.request_timeout = request_timeout
+        self.symbol_index = get_symbol_index(repo_dir, language) if backend == "static" else None
+        # Calls answered by the language server because they were ambiguous
+        self.lsp_fallbacks = 0
 
     def execute_goto_definition(self, file_path: str, position: Point):
+        return self.lsp_cache.request(
+            "definition",
+            self.repo_dir,
+            file_path,
+            position,
+            self.overlay,
+            lambda: self._request_definition(file_path, position),
+        )
+
+    def execute_goto_references(self, file_path: str, position: Point):
+        return self.lsp_cache.request(
+            "references",
+            self.repo_dir,
+            file_path,
+            position,
+            self.overlay,
+            lambda: self._request_references(file_path, position),
+        )
+
+    @staticmethod
+    def _definition_from_lsp(lsf):
+        if not lsf:
+            return None
+        return {
+            "file_path": lsf[0]["absolutePath"],
+            "range": lsprange2range(lsf[0]["range"]),
+        }
+
+    @staticmethod
+    def _references_from_lsp(lsf):
+        if not lsf:
+            return None
+        return [
+            {"file_path": ref["absolutePath"], "range": lsprange2range(ref["range"])}
+            for ref in lsf
+        ]
+
+    def _request_definition(self, file_path: str, position: Point):
         start = time.time()
         logger.debug(f"Execute goto definition for {file_path} at {position} ...")
         lsf = self.language_server.request_definition(
@@ -23,83 +105,157 @@ class SimilarUsageService:
         )
         logger.debug(f"Definition: {lsf}")
         logger.debug(f"Language Server tooks: {time.time() - start} s")
-        if not lsf:
-            return None
-        else:
-            return {
-                "file_path": lsf[0]["absolutePath"],
-                "range": lsprange2irange(lsf[0]["range"]),
-            }
+        return self._definition_from_lsp(lsf)
 
-    def execute_goto_references(self, file_path: str, position: Point):
+    def _request_references(self, file_path: str, position: Point):
         start = time.time()
         logger.debug(f"Execute goto references for {file_path} at {position} ...")
         lsf = self.language_server.request_references(
             file_path, position.row, position.column
         )
         logger.debug(f"Language Server tooks: {time.time() - start} s")
-        if not lsf:
+        return self._references_from_lsp(lsf)
+
+    async def _send_requests(self, method: str, requests: List[Tuple[str, Point]]):
+        """(response, seconds) of every request, sent together to the async server.
+
+        Runs in the event loop of the started `SyncLanguageServer`. A request
+        that times out gets (None, None), and is cancelled in the server.
+        """
+        server = self.language_server.language_server
+        send = server.request_definition if method == "definition" else server.request_references
+
+        async def send_one(file_path: str, position: Point):
+            start = time.time()
+            # Id of the request sent below, which gets it before its first await
+            request_id = server.server.request_id
+            try:
+                async with asyncio.timeout(self.request_timeout):
+                    lsf = await send(file_path, position.row, position.column)
+            except TimeoutError:
+                logger.warning(f"Goto {method} for {file_path} at {position} timed out")
+                # Its late reply, a RequestCancelled error, goes to the abandoned handler
+                server.server.notify.cancel_request({"id": request_id})
+                # The `open_file` of the request has no finally releasing the document
+                release_document(server, pathlib.Path(os.path.abspath(file_path)).as_uri())
+                return None, None
+            return lsf, time.time() - start
+
+        return await asyncio.gather(*(send_one(file_path, position) for file_path, position in requests))
+
+    def request_concurrently(self, method: str, requests: List[Tuple[str, Point]]) -> list:
+        """Results of goto `method` for every (file_path, position), in order.
+
+        Cached results are served first, the other distinct requests are all
+        in flight at once, so they take as long as the slowest one.
+        """
+        results = {}
+        pending = []
+        for request in dict.fromkeys(requests):
+            hit, result = self.lsp_cache.lookup(method, self.repo_dir, *request, self.overlay)
+            if hit:
+                results[request] = result
+            else:
+                pending.append(request)
+        if pending:
+            start = time.time()
+            responses = asyncio.run_coroutine_threadsafe(
+                self._send_requests(method, pending), self.language_server.loop
+            ).result()
+            logger.debug(f"{len(pending)} goto {method} requests took {time.time() - start} s")
+            from_lsp = self._definition_from_lsp if method == "definition" else self._references_from_lsp
+            for request, (lsf, elapsed) in zip(pending, responses):
+                results[request] = from_lsp(lsf)
+                if elapsed is not None:
+                    self.lsp_cache.store(
+                        method, self.repo_dir, *request, self.overlay, results[request], elapsed
+                    )
+        return [results[request] for request in requests]
+
+    def get_static_usages_for_node(self, file_path: str, node: Node):
+        """Usages from the symbol index, None when the language server should decide"""
+        definitions = self.symbol_index.definitions_at(file_path, node)
+        if not definitions:
+            return []
+        if len(definitions) > 1 and self.language_server is not None:
+            self.lsp_fallbacks += 1
             return None
-        else:
-            references = list(
-                map(
-                    lambda ref: {
-                        "file_path": ref["absolutePath"],
-                        "range": lsprange2irange(ref["range"]),
-                    },
-                    lsf,
-                )
+        current = call_site_of(node, os.path.abspath(file_path), self.language)
+        return [
+            {"file_path": call_site.file_path, "range": call_site.range}
+            for call_site in self.symbol_index.references(definitions[0])
+            # Remove the current usage
+            if call_site.file_path != current.file_path or call_site.range != current.range
+        ]
+
+    @staticmethod
+    def _filter_usages(file_path: str, node: Node, def_symbol: dict, symbol_usages) -> list:
+        return [
+            usage
+            for usage in symbol_usages or []
+            if (
+                usage["file_path"] != def_symbol["file_path"]  # Remove the definition itself
+                or usage["range"].start_point != def_symbol["range"].start_point
+            )
+            and (
+                usage["file_path"] != file_path
+                or usage["range"].start_point != node.start_point  # Remove the current usage
             )
-            return references
+        ]
 
     def get_similar_usages_for_node(self, file_path: str, node: Node):
-        match node.type:
-            case (
-                "call_expression"  # Typescript function invocation
-                | "method_invocation"  # Java method invocation
-                | "call"  # Python function invocation and new class instance
-                | "new_expression"  # Typescript function invocation
-                | "object_creation_expression"  # Java new class instance
-            ):
-                def_symbol = self.execute_goto_definition(file_path, node.start_point)
-                if not def_symbol:
-                    return []
-
-                symbol_usages = self.execute_goto_references(
-                    def_symbol["file_path"], def_symbol["range"].start_point
-                )
-                filtered_symbol_usages = list(
-                    filter(
-                        lambda usage: (
-                            (
-                                usage["file_path"]
-                                != def_symbol[
-                                    "file_path"
-                                ]  # Remove the definition itself
-                                or usage["range"].start_point
-                                != def_symbol["range"].start_point
-                            )
-                            and (
-                                usage["file_path"] != file_path
-                                or usage["range"].start_point
-                                != node.start_point  # Remove the current usage
-                            )
-                        ),
-                        symbol_usages,
-                    )
-                )
-                return filtered_symbol_usages
-            case _:
-                pass
-        return None
+        if node.type not in USAGE_NODE_TYPES:
+            return None
+        if self.backend == "static":
+            static_usages = self.get_static_usages_for_node(file_path, node)
+            if static_usages is not None:
+                return static_usages
+        def_symbol = self.execute_goto_definition(file_path, node.start_point)
+        if not def_symbol:
+            return []
+
+        symbol_usages = self.execute_goto_references(
+            def_symbol["file_path"], def_symbol["range"].start_point
+        )
+        return self._filter_usages(file_path, node, def_symbol, symbol_usages)
+
+    def get_similar_usages_concurrently(self, file_path: str, nodes: List[Node]) -> list:
+        """Same usages as `get_similar_usages_for_node` for every node, in order.
+
+        The definitions of all call nodes are requested at once, then the
+        references of all of them.
+        """
+        usages = {}
+        lsp_nodes = []
+        for node in nodes:
+            if node.type not in USAGE_NODE_TYPES:
+                continue
+            if self.backend == "static":
+                usages[node.id] = self.get_static_usages_for_node(file_path, node)
+                if usages[node.id] is not None:
+                    continue
+            lsp_nodes.append(node)
+
+        def_symbols = self.request_concurrently(
+            "definition", [(file_path, node.start_point) for node in lsp_nodes]
+        )
+        resolved = [
+            (node, def_symbol) for node, def_symbol in zip(lsp_nodes, def_symbols) if def_symbol
+        ]
+        all_symbol_usages = self.request_concurrently(
+            "references",
+            [(def_symbol["file_path"], def_symbol["range"].start_point) for _, def_symbol in resolved],
+        )
+        for (node, def_symbol), symbol_usages in zip(resolved, all_symbol_usages):
+            usages[node.id] = self._filter_usages(file_path, node, def_symbol, symbol_usages)
+        return [usage for node in nodes for usage in usages.get(node.id) or []]
 
     def get_similar_usages(
         self, file_path: str, prefix: str, suffix: str, cursor_index: Point
     ):
-        with open(file_path, "r") as inputfile:
-            content = inputfile.read()
+        content = get_line_index(file_path, self.overlay).content
         try:
-            ast = get_ast(content, self.language)
+            ast = get_ast(content, self.language, file_path)
 
             if not ast:
                 return []
@@ -108,11 +264,25 @@ class SimilarUsageService:
             if not tree_path:
                 return []
             results = []
-            for node in reversed(tree_path):
-                similar_usages = self.get_similar_usages_for_node(file_path, node)
-                if similar_usages:
-                    results.extend(similar_usages)
+            if self.symbol_index is not None:
+                # Only the file under the cursor differs from the repo on disk
+                self.symbol_index.discard_overrides(keep=file_path)
+                self.symbol_index.update_file(file_path, content)
+            with (
+                open_overlay_documents(self.language_server, self.overlay)
+                if self.language_server is not None
+                else nullcontext()
+            ):
+                if self.concurrent and self.language_server is not None:
+                    return self.get_similar_usages_concurrently(file_path, list(reversed(tree_path)))
+                for node in reversed(tree_path):
+                    similar_usages = self.get_similar_usages_for_node(file_path, node)
+                    if similar_usages:
+                        results.extend(similar_usages)
             return results
+        except multilspy.lsp_protocol_handler.server.Error:
+            # The server is broken, the caller restarts it
+            raise
         except Exception as e:
             logger.error(f"Error getting definitions from LSP {e}")
             return []
@@ -0,0 +1,148 @@
+import weakref
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from chunk_index import ChunkIndex
+
+_SPARSE_MATRICES: "weakref.WeakKeyDictionary[ChunkIndex, SparseChunkMatrix]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def gather_ranges(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Concatenation of arange(start, end) for every pair, without a Python loop"""
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(total)
+
+
+class SparseChunkMatrix:
+    """Binary chunk x token incidence matrix of the chunks on disk, stored column-wise.
+
+    Intersections of a batch of queries with every chunk are the product of the
+    query incidence matrix with this one, computed with a single `np.bincount`
+    over the postings of the query tokens. Unions follow from the row sums.
+    """
+
+    def __init__(self, records: Dict[str, dict], version: int = 0):
+        self.version = version
+        self.chunks: List[dict] = []
+        self.file_ranges: Dict[str, Tuple[int, int]] = {}
+        token_arrays = []
+        for file_path in sorted(records):
+            start = len(self.chunks)
+            for chunk in records[file_path]["chunks"]:
+                self.chunks.append({**chunk, "file_path": file_path})
+                token_arrays.append(np.unique(np.asarray(chunk["encoded"], dtype=np.int64)))
+            self.file_ranges[file_path] = (start, len(self.chunks))
+
+        self.sizes = np.array([len(tokens) for tokens in token_arrays], dtype=np.int64)
+        all_tokens = (
+            np.concatenate(token_arrays) if token_arrays else np.zeros(0, dtype=np.int64)
+        )
+        rows = np.repeat(np.arange(len(self.chunks)), self.sizes)
+        self.vocab, columns = np.unique(all_tokens, return_inverse=True)
+        order = np.argsort(columns, kind="stable")
+        self.indices = rows[order]
+        self.indptr = np.zeros(len(self.vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(columns, minlength=len(self.vocab)), out=self.indptr[1:])
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def _columns(self, query: np.ndarray) -> np.ndarray:
+        """Columns of the query tokens, tokens absent from every chunk are dropped"""
+        if len(self.vocab) == 0:
+            return np.zeros(0, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.vocab, query), len(self.vocab) - 1)
+        return positions[self.vocab[positions] == query]
+
+    def scores(self, queries: List[np.ndarray]) -> np.ndarray:
+        """Jaccard similarity of every query (unique token ids) with every chunk"""
+        n_chunks = len(self.chunks)
+        query_columns = [self._columns(query) for query in queries]
+        n_postings = [
+            int((self.indptr[columns + 1] - self.indptr[columns]).sum())
+            for columns in query_columns
+        ]
+        row_ids = np.repeat(np.arange(len(queries)), n_postings)
+        columns = np.concatenate(query_columns + [np.zeros(0, dtype=np.int64)])
+        chunk_ids = self.indices[gather_ranges(self.indptr[columns], self.indptr[columns + 1])]
+        intersections = np.bincount(
+            row_ids * n_chunks + chunk_ids, minlength=len(queries) * n_chunks
+        ).reshape(len(queries), n_chunks)
+        query_sizes = np.array([len(query) for query in queries], dtype=np.int64)
+        unions = query_sizes[:, None] + self.sizes[None, :] - intersections
+        return intersections / np.maximum(unions, 1)
+
+    @staticmethod
+    def _top_indices(row_scores: np.ndarray, n_top: int) -> np.ndarray:
+        """Indices of the `n_top` best scores, ties going to the first chunks"""
+        if n_top == 0:
+            return np.zeros(0, dtype=np.int64)
+        kth_score = -np.partition(-row_scores, n_top - 1)[n_top - 1]
+        above = np.flatnonzero(row_scores > kth_score)
+        ties = np.flatnonzero(row_scores == kth_score)[: n_top - len(above)]
+        top = np.concatenate([above, ties])
+        return top[np.argsort(-row_scores[top], kind="stable")]
+
+    def top_k(
+        self,
+        queries: List[List[int]],
+        k: int,
+        excluded_files: Optional[List[Optional[str]]] = None,
+        extra_chunks: Optional[List[List[dict]]] = None,
+        batch_size: int = 256,
+        max_batch_scores: int = 1 << 22,
+    ) -> List[List[Tuple[dict, float]]]:
+        """Top-k chunks of every query by Jaccard similarity.
+
+        The chunks of `excluded_files[i]` are ignored for query i and
+        `extra_chunks[i]` are scored in addition, so that the file under the
+        cursor can be replaced by its modified content. Ties are broken by
+        chunk order, extra chunks last. Batches are cut so that their score
+        matrix holds at most `max_batch_scores` entries.
+        """
+        excluded_files = excluded_files or [None] * len(queries)
+        extra_chunks = extra_chunks or [[] for _ in queries]
+        unique_queries = [np.unique(np.asarray(query, dtype=np.int64)) for query in queries]
+        batch_size = max(1, min(batch_size, max_batch_scores // max(len(self.chunks), 1)))
+        results = []
+        for batch_start in range(0, len(queries), batch_size):
+            batch = unique_queries[batch_start : batch_start + batch_size]
+            scores = self.scores(batch)
+            for row, query in enumerate(batch):
+                i = batch_start + row
+                row_scores = scores[row]
+                if excluded_files[i] in self.file_ranges:
+                    start, end = self.file_ranges[excluded_files[i]]
+                    row_scores[start:end] = -1.0
+                n_top = min(k, len(row_scores))
+                top = self._top_indices(row_scores, n_top)
+                ranked = [
+                    (self.chunks[chunk_id], float(row_scores[chunk_id]))
+                    for chunk_id in top
+                    if row_scores[chunk_id] >= 0
+                ]
+                query_set = frozenset(query.tolist())
+                for chunk in extra_chunks[i]:
+                    token_set = frozenset(chunk["encoded"])
+                    intersection = len(query_set & token_set)
+                    union = len(query_set) + len(token_set) - intersection
+                    ranked.append((chunk, intersection / max(union, 1)))
+                ranked.sort(key=lambda item: -item[1])
+                results.append(ranked[:k])
+        return results
+
+
+def get_sparse_matrix(chunk_index: ChunkIndex) -> SparseChunkMatrix:
+    """Incidence matrix of the chunks on disk, rebuilt when the chunk index changed"""
+    matrix = _SPARSE_MATRICES.get(chunk_index)
+    if matrix is None or matrix.version != chunk_index.version:
+        matrix = SparseChunkMatrix(chunk_index.files, chunk_index.version)
+        _SPARSE_MATRICES[chunk_index] = matrix
+    return matrix
@@ -0,0 +1,428 @@
+import logging
+import os
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from tree_sitter import Node
+
+from common_funcs import LANG_EXTENSIONS, Range, get_ast
+from line_index import get_line_index
+
+logger = logging.getLogger("symbol_index")
+
+# Symbol indexes live in memory across rows of the same process, keyed by
+# (repo_dir, language)
+_INDEXES: Dict[tuple, "SymbolIndex"] = {}
+
+TYPE_DECLARATION_NODE_TYPES = {
+    "java": {
+        "class_declaration",
+        "interface_declaration",
+        "enum_declaration",
+        "record_declaration",
+        "annotation_type_declaration",
+    },
+    "python": {"class_definition"},
+}
+METHOD_DECLARATION_NODE_TYPES = {
+    "java": {"method_declaration", "constructor_declaration"},
+    "python": {"function_definition"},
+}
+CALL_NODE_TYPES = {
+    "java": {"method_invocation", "object_creation_expression"},
+    "python": {"call"},
+}
+
+
+class Definition(NamedTuple):
+    name: str
+    qualified_name: str
+    # "type", "method" or "constructor"
+    kind: str
+    file_path: str
+    # Range of the name, like the location of an LSP definition
+    range: Range
+    # Qualified name of the enclosing type or module
+    container: str
+    # Number of parameters, None when any number of arguments is accepted
+    num_params: Optional[int]
+
+
+class CallSite(NamedTuple):
+    name: str
+    # "invocation" or "creation"
+    kind: str
+    file_path: str
+    # Range of the called name, like the location of an LSP reference
+    range: Range
+    num_args: int
+    # Simple name of the type the method is called on, when it is known
+    receiver_type: Optional[str] = None
+
+
+class FileSymbols(NamedTuple):
+    # Package of a Java file, dotted module path of a Python file
+    scope: str
+    imports: Set[str]
+    definitions: List[Definition]
+    call_sites: List[CallSite]
+
+
+def _text(node: Node) -> str:
+    return node.text.decode("utf-8", errors="replace")
+
+
+def _name_range(node: Node) -> Range:
+    return Range(node.start_point, node.end_point)
+
+
+def _num_params(node: Node, language: str) -> Optional[int]:
+    parameters = node.child_by_field_name("parameters")
+    if parameters is None:
+        return 0
+    if language == "python":
+        # Defaults, *args and **kwargs make the arity of Python calls unreliable
+        return None
+    params = [child for child in parameters.named_children if child.type != "receiver_parameter"]
+    if any(child.type == "spread_parameter" for child in params):
+        return None
+    return len(params)
+
+
+def _type_name(node: Optional[Node]) -> Optional[Node]:
+    """Identifier of a type node, `Foo` for `Foo<T>` and `outer.Foo`"""
+    while node is not None and node.type in ("generic_type", "scoped_type_identifier"):
+        children = [child for child in node.named_children if child.type != "type_arguments"]
+        node = children[0] if node.type == "generic_type" else children[-1]
+    return node
+
+
+def call_site_of(node: Node, file_path: str, language: str) -> Optional[CallSite]:
+    """Called name of a call or instantiation node, None for any other node.
+
+    `receiver_type` is left to the text of the receiver, see `extract_symbols`.
+    """
+    name_node = receiver = None
+    kind = "invocation"
+    if node.type == "method_invocation":
+        name_node = node.child_by_field_name("name")
+        receiver = node.child_by_field_name("object")
+    elif node.type == "object_creation_expression":
+        kind = "creation"
+        name_node = _type_name(node.child_by_field_name("type"))
+    elif node.type == "call":
+        name_node = node.child_by_field_name("function")
+        if name_node is not None and name_node.type == "attribute":
+            receiver = name_node.child_by_field_name("object")
+            name_node = name_node.child_by_field_name("attribute")
+    if name_node is None or name_node.type not in ("identifier", "type_identifier"):
+        return None
+    arguments = node.child_by_field_name("arguments")
+    num_args = len(arguments.named_children) if arguments is not None else 0
+    receiver_text = (
+        _text(receiver) if receiver is not None and receiver.type in ("identifier", "this") else None
+    )
+    return CallSite(_text(name_node), kind, file_path, _name_range(name_node), num_args, receiver_text)
+
+
+def _declared_type(node: Node, language: str) -> Optional[Tuple[str, str]]:
+    """(variable, simple type name) declared by a node, None for any other node"""
+    if node.type in ("local_variable_declaration", "field_declaration", "formal_parameter"):
+        type_node = _type_name(node.child_by_field_name("type"))
+        if node.type == "formal_parameter":
+            name_node = node.child_by_field_name("name")
+        else:
+            declarator = node.child_by_field_name("declarator")
+            name_node = declarator.child_by_field_name("name") if declarator is not None else None
+        if type_node is not None and name_node is not None:
+            return _text(name_node), _text(type_node)
+    elif language == "python" and node.type == "assignment":
+        # t = Thing(...)
+        left, right = node.child_by_field_name("left"), node.child_by_field_name("right")
+        if left is not None and left.type == "identifier" and right is not None and right.type == "call":
+            function = right.child_by_field_name("function")
+            if function is not None and function.type == "identifier" and _text(function)[:1].isupper():
+                return _text(left), _text(function)
+    return None
+
+
+def extract_symbols(file_path: str, content: str, language: str, scope: str) -> FileSymbols:
+    """Definitions and call sites of one file, qualified under `scope`"""
+    ast = get_ast(content, language, file_path)
+    for child in ast.root_node.named_children:
+        if child.type == "package_declaration" and child.named_children:
+            scope = _text(child.named_children[0])
+    symbols = FileSymbols(scope, set(), [], [])
+    type_node_types = TYPE_DECLARATION_NODE_TYPES[language]
+    method_node_types = METHOD_DECLARATION_NODE_TYPES[language]
+    call_node_types = CALL_NODE_TYPES[language]
+    # Variables of the file by name, regardless of their scope
+    variable_types: Dict[str, str] = {}
+    # Enclosing type of every call site, for calls on `this` or without receiver
+    call_site_types: List[Optional[str]] = []
+    # Explicit stack of (node, qualified name of the enclosing type or module),
+    # chained calls nest deeper than the recursion limit
+    stack: List[Tuple[Node, str]] = [(ast.root_node, scope)]
+    while stack:
+        node, container = stack.pop()
+        node_type = node.type
+        declared = _declared_type(node, language)
+        if declared is not None:
+            variable_types.setdefault(*declared)
+        if node_type == "import_declaration":
+            imported = _text(node.named_children[0])
+            if any(child.type == "asterisk" for child in node.named_children):
+                imported += ".*"
+            symbols.imports.add(imported)
+            continue
+        if node_type in ("import_statement", "import_from_statement"):
+            module = node.child_by_field_name("module_name")
+            prefix = _text(module) + "." if module is not None else ""
+            for child in node.children_by_field_name("name"):
+                name = child.child_by_field_name("name") if child.type == "aliased_import" else child
+                symbols.imports.add(prefix + _text(name))
+            if module is not None:
+                symbols.imports.add(_text(module))
+            continue
+
+        if node_type in type_node_types or node_type in method_node_types:
+            name_node = node.child_by_field_name("name")
+            if name_node is not None:
+                name = _text(name_node)
+                qualified_name = f"{container}.{name}" if container else name
+                if node_type in type_node_types:
+                    kind, num_params = "type", None
+                else:
+                    kind = "constructor" if node_type == "constructor_declaration" else "method"
+                    num_params = _num_params(node, language)
+                symbols.definitions.append(
+                    Definition(
+                        name, qualified_name, kind, file_path, _name_range(name_node), container, num_params
+                    )
+                )
+                if node_type in type_node_types:
+                    container = qualified_name
+        elif node_type in call_node_types:
+            call_site = call_site_of(node, file_path, language)
+            if call_site is not None:
+                symbols.call_sites.append(call_site)
+                call_site_types.append(
+                    container.rsplit(".", 1)[-1] if container != symbols.scope else None
+                )
+        stack.extend((child, container) for child in reversed(node.named_children))
+
+    for i, (call_site, enclosing_type) in enumerate(zip(symbols.call_sites, call_site_types)):
+        receiver = call_site.receiver_type
+        if call_site.kind == "creation":
+            receiver_type = None
+        elif receiver is None:
+            # Java methods called without receiver are those of the enclosing type
+            receiver_type = enclosing_type if language == "java" else None
+        elif receiver in ("this", "self"):
+            receiver_type = enclosing_type
+        elif receiver in variable_types:
+            receiver_type = variable_types[receiver]
+        else:
+            # Static calls on a type
+            receiver_type = receiver if receiver[:1].isupper() else None
+        symbols.call_sites[i] = call_site._replace(receiver_type=receiver_type)
+    return symbols
+
+
+class SymbolIndex:
+    """Repo-wide definitions and call sites extracted with tree-sitter.
+
+    Answers goto-definition and goto-references for calls and instantiations
+    from memory, without a language server. Names are resolved statically: the
+    definitions with the called name, the right kind and, for Java, the right
+    number of parameters, preferring the same file, then the same package or
+    imported types. A call that stays ambiguous resolves to every remaining
+    definition, see `SimilarUsageService` for the LSP fallback.
+
+    Like `ChunkIndex`, files are re-extracted when they change on disk and
+    in-memory content is kept as overrides that are never merged into disk records.
+    """
+
+    def __init__(self, repo_dir: str, language: str):
+        # Absolute paths everywhere, like the locations of the language server
+        self.repo_dir = os.path.abspath(repo_dir)
+        self.language = language
+        # file_path -> {"mtime", "size", "symbols"}
+        self.files: Dict[str, dict] = {}
+        # file_path -> FileSymbols for content that is not on disk
+        self.overrides: Dict[str, FileSymbols] = {}
+        # name -> file_path -> definitions or call sites of the current symbols
+        self.definitions: Dict[str, Dict[str, List[Definition]]] = {}
+        self.call_sites: Dict[str, Dict[str, List[CallSite]]] = {}
+        self._resolved: Dict[CallSite, List[Definition]] = {}
+
+    def _scope_of(self, file_path: str) -> str:
+        if self.language != "python":
+            # Taken from the package declaration of the file
+            return ""
+        relative_path = os.path.relpath(file_path, self.repo_dir)
+        module = os.path.splitext(relative_path)[0].replace(os.path.sep, ".")
+        return module[: -len(".__init__")] if module.endswith(".__init__") else module
+
+    def _source_files(self) -> List[str]:
+        file_paths = []
+        for subdir, dirs, files in os.walk(self.repo_dir):
+            for file in files:
+                if file.endswith(LANG_EXTENSIONS[self.language]):
+                    file_paths.append(os.path.join(subdir, file))
+        return file_paths
+
+    def _current(self, file_path: str) -> Optional[FileSymbols]:
+        if file_path in self.overrides:
+            return self.overrides[file_path]
+        record = self.files.get(file_path)
+        return record["symbols"] if record else None
+
+    def _replace(self, file_path: str, symbols: Optional[FileSymbols]):
+        """Swap the symbols of one file in the name maps"""
+        old_symbols = self._current(file_path)
+        if old_symbols is not None:
+            for name in {definition.name for definition in old_symbols.definitions}:
+                self.definitions[name].pop(file_path, None)
+            for name in {call_site.name for call_site in old_symbols.call_sites}:
+                self.call_sites[name].pop(file_path, None)
+        if symbols is not None:
+            for definition in symbols.definitions:
+                self.definitions.setdefault(definition.name, {}).setdefault(file_path, []).append(definition)
+            for call_site in symbols.call_sites:
+                self.call_sites.setdefault(call_site.name, {}).setdefault(file_path, []).append(call_site)
+        self._resolved = {}
+
+    def refresh(self) -> int:
+        """Re-extract the files that changed on disk, returns their number"""
+        file_paths = self._source_files()
+        updated = 0
+        for file_path in file_paths:
+            stat = os.stat(file_path)
+            record = self.files.get(file_path)
+            if record and record["mtime"] == stat.st_mtime_ns and record["size"] == stat.st_size:
+                continue
+            try:
+                content = get_line_index(file_path).content
+            except (OSError, UnicodeDecodeError) as e:
+                logger.warning(f"Skip {file_path}: {e}")
+                continue
+            symbols = extract_symbols(file_path, content, self.language, self._scope_of(file_path))
+            if file_path not in self.overrides:
+                self._replace(file_path, symbols)
+            self.files[file_path] = {"mtime": stat.st_mtime_ns, "size": stat.st_size, "symbols": symbols}
+            updated += 1
+        for file_path in self.files.keys() - set(file_paths):
+            if file_path not in self.overrides:
+                self._replace(file_path, None)
+            del self.files[file_path]
+        logger.debug(f"Refreshed symbols of {self.repo_dir}: {updated} re-extracted")
+        return updated
+
+    def update_file(self, file_path: str, content: str):
+        """Index `content` as an in-memory override of the file, see `discard_overrides`"""
+        file_path = os.path.abspath(file_path)
+        symbols = extract_symbols(file_path, content, self.language, self._scope_of(file_path))
+        self._replace(file_path, symbols)
+        self.overrides[file_path] = symbols
+
+    def discard_overrides(self, keep: Optional[str] = None):
+        keep = os.path.abspath(keep) if keep else None
+        for file_path in list(self.overrides):
+            if file_path == keep:
+                continue
+            record = self.files.get(file_path)
+            self._replace(file_path, record["symbols"] if record else None)
+            del self.overrides[file_path]
+
+    def _is_visible(self, definition: Definition, symbols: FileSymbols) -> bool:
+        """Whether the definition is in the same package or module or imported"""
+        if definition.container == symbols.scope:
+            return True
+        if self.language == "python":
+            return definition.container in symbols.imports or definition.qualified_name in symbols.imports
+        # Java imports name types, `container` is the declaring type of a method
+        type_name = definition.qualified_name if definition.kind == "type" else definition.container
+        package = type_name.rsplit(".", 1)[0]
+        return (
+            type_name in symbols.imports
+            or package + ".*" in symbols.imports
+            or package == symbols.scope
+        )
+
+    def resolve(self, call_site: CallSite) -> List[Definition]:
+        """Definitions the call site may refer to, best matches only"""
+        resolved = self._resolved.get(call_site)
+        if resolved is not None:
+            return resolved
+        candidates = [
+            definition
+            for definitions in self.definitions.get(call_site.name, {}).values()
+            for definition in definitions
+        ]
+        if call_site.kind == "creation":
+            # Constructors of the created type, the type itself without any
+            candidates = [d for d in candidates if d.kind == "constructor"] or [
+                d for d in candidates if d.kind == "type"
+            ]
+        elif self.language == "java":
+            candidates = [d for d in candidates if d.kind == "method"]
+        candidates = [
+            d for d in candidates if d.num_params is None or d.num_params == call_site.num_args
+        ] or candidates
+        if call_site.receiver_type is not None:
+            candidates = [
+                d for d in candidates if d.container.rsplit(".", 1)[-1] == call_site.receiver_type
+            ] or candidates
+        symbols = self._current(call_site.file_path)
+        same_file = [d for d in candidates if d.file_path == call_site.file_path]
+        if same_file:
+            resolved = same_file
+        elif symbols is not None:
+            resolved = [d for d in candidates if self._is_visible(d, symbols)] or candidates
+        else:
+            resolved = candidates
+        self._resolved[call_site] = resolved
+        return resolved
+
+    def definitions_at(self, file_path: str, node: Node) -> List[Definition]:
+        """Static goto-definition of a call or instantiation node"""
+        file_path = os.path.abspath(file_path)
+        call_site = call_site_of(node, file_path, self.language)
+        if call_site is None:
+            return []
+        symbols = self._current(file_path)
+        if symbols is not None:
+            # The indexed call site knows the type of its receiver
+            for indexed_call_site in symbols.call_sites:
+                if indexed_call_site.range == call_site.range:
+                    return self.resolve(indexed_call_site)
+        return self.resolve(call_site._replace(receiver_type=None))
+
+    def references(self, definition: Definition) -> List[CallSite]:
+        """Static goto-references: the call sites that may resolve to the definition"""
+        # Constructors are referenced by instantiations, which carry the type name
+        return [
+            call_site
+            for call_sites in self.call_sites.get(definition.name, {}).values()
+            for call_site in call_sites
+            if definition in self.resolve(call_site)
+        ]
+
+    def stats(self) -> dict:
+        return {
+            "files": len(self.files),
+            "overrides": len(self.overrides),
+            "definitions": sum(len(d) for by_file in self.definitions.values() for d in by_file.values()),
+            "call_sites": sum(len(c) for by_file in self.call_sites.values() for c in by_file.values()),
+        }
+
+
+def get_symbol_index(repo_dir: str, language: str) -> SymbolIndex:
+    """Symbol index of the repo, refreshed against the files on disk"""
+    key = (os.path.abspath(repo_dir), language)
+    index = _INDEXES.get(key)
+    if index is None:
+        index = SymbolIndex(repo_dir, language)
+        _INDEXES[key] = index
+    index.refresh()
+    return index
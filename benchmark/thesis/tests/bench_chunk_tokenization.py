@@ -0,0 +1,76 @@
+"""Measure the chunking throughput (lines/sec) of a repo with per-line and batched tokenization.
+
+Both variants must produce the same chunks, the script fails otherwise.
+"""
+import argparse
+import io
+import os
+import sys
+import time
+from typing import List
+
+CWD = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CWD, ".."))
+from chunk_index import EXTENSION
+from similar_code import SimilarCodeService
+
+
+class PerLineSimilarCodeService(SimilarCodeService):
+    """Previous behaviour: one tokenizer call per source line"""
+
+    def _count_line_tokens(self, file_lines: List[str]) -> List[int]:
+        return [len(self.tokenizer(line)["input_ids"]) for line in file_lines]
+
+
+def read_files(repo_dir: str, language: str) -> dict:
+    contents = {}
+    for subdir, dirs, files in os.walk(repo_dir):
+        for file in files:
+            if file.endswith(EXTENSION[language]):
+                file_path = os.path.join(subdir, file)
+                with open(file_path, "r") as f:
+                    contents[file_path] = f.read()
+    return contents
+
+
+def run(service: SimilarCodeService, contents: dict):
+    start = time.time()
+    chunks = {
+        file_path: service._chunk_code(file_path, content)
+        for file_path, content in contents.items()
+    }
+    return chunks, time.time() - start
+
+
+def main(args):
+    contents = read_files(args.repo_dir, args.language)
+    num_lines = sum(len(io.StringIO(content).readlines()) for content in contents.values())
+    print(f"Files: {len(contents)}, lines: {num_lines}")
+
+    results = {}
+    for name, service_class in [
+        ("per-line", PerLineSimilarCodeService),
+        ("batched", SimilarCodeService),
+    ]:
+        service = service_class(cached_dir=args.cached_dir)
+        chunks, elapsed = run(service, contents)
+        results[name] = chunks
+        print(f"{name}: {elapsed:.3f} s, {num_lines / elapsed:.0f} lines/sec")
+
+    if results["per-line"] != results["batched"]:
+        raise AssertionError("Batched tokenization changed the chunk boundaries")
+    print("Chunks are identical")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--repo-dir", dest="repo_dir", required=True)
+    parser.add_argument("-lang", "--language", dest="language", default="java")
+    parser.add_argument(
+        "-c",
+        "--cached-dir",
+        dest="cached_dir",
+        default=os.path.join(CWD, "..", "..", "..", "data", "chunked"),
+    )
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,59 @@
+"""Measure the import time of `common_funcs` and the cost of the first tokenization.
+
+Every measurement runs in a fresh interpreter. The eager baseline imports
+transformers and loads the tokenizer up front, as importing `common_funcs`
+used to.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+CWD = os.path.dirname(os.path.abspath(__file__))
+THESIS_DIR = os.path.join(CWD, "..")
+
+SNIPPETS = {
+    "import common_funcs": "import common_funcs",
+    "import common_funcs + first tokenization": (
+        "import common_funcs; common_funcs.TOKENIZER('int a = 1;')"
+    ),
+    "eager baseline": (
+        "import common_funcs; common_funcs.TOKENIZER.load()"
+    ),
+}
+
+
+def measure(code: str, repeats: int) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.time()
+        subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=THESIS_DIR,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main(args):
+    baseline = measure("pass", args.repeats)
+    print(f"Interpreter start-up: {baseline:.3f} s")
+    results = {}
+    for name, code in SNIPPETS.items():
+        results[name] = measure(code, args.repeats) - baseline
+        print(f"{name}: {results[name]:.3f} s")
+    print(
+        "import common_funcs takes "
+        f"{results['import common_funcs'] / results['eager baseline']:.1%} of the eager baseline"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--repeats", dest="repeats", type=int, default=5)
+    args = parser.parse_args()
+    main(args)
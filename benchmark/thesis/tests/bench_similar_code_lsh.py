@@ -0,0 +1,107 @@
+"""Compare the top-10 of the approximate MinHash/LSH similar code mode against the exact ranking.
+
+Query windows are taken around random lines of random files of the repo, as
+`SimilarCodeService.get_similar_code` does around the cursor. The share of
+queries with fewer than k LSH candidates, filled from the exact index, is
+reported with the mean latency of that fallback.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+from tree_sitter import Point
+
+CWD = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CWD, ".."))
+from similar_code import SimilarCodeService
+from utils import get_window_around_cursor
+
+
+def sample_queries(service: SimilarCodeService, files: dict, num_queries: int, seed: int):
+    rng = random.Random(seed)
+    file_paths = sorted(files)
+    queries = []
+    while len(queries) < num_queries:
+        with open(rng.choice(file_paths), "r") as f:
+            file_lines = f.read().splitlines()
+        if not file_lines:
+            continue
+        cursor = Point(row=rng.randrange(len(file_lines)), column=0)
+        query_text = get_window_around_cursor(cursor, file_lines)
+        queries.append(service.tokenizer(query_text)["input_ids"])
+    return queries
+
+
+def key(chunk: dict):
+    return chunk["file_path"], chunk["range"]
+
+
+def main(args):
+    exact_service = SimilarCodeService(cached_dir=args.cached_dir)
+    index = exact_service.chunk_project(args.repo_dir, args.language)
+    queries = sample_queries(exact_service, index.files, args.num_queries, args.seed)
+
+    start = time.time()
+    exact_retriever = exact_service.get_retriever(index)
+    exact_build_time = time.time() - start
+    start = time.time()
+    exact_results = [exact_retriever.top_k(query, args.top_k) for query in queries]
+    exact_query_time = (time.time() - start) / len(queries)
+    print(f"Chunks: {len(exact_retriever)}, queries: {len(queries)}")
+    print(
+        f"exact: build {exact_build_time:.3f} s, query {exact_query_time * 1000:.3f} ms"
+    )
+
+    for bands in args.bands:
+        for rows in args.rows:
+            service = SimilarCodeService(
+                cached_dir=args.cached_dir, mode="lsh", lsh_bands=bands, lsh_rows=rows
+            )
+            start = time.time()
+            retriever = service.get_retriever(index)
+            build_time = time.time() - start
+            fallbacks, fallback_time = retriever.fallbacks, retriever.fallback_time
+            start = time.time()
+            results = [retriever.top_k(query, args.top_k) for query in queries]
+            query_time = (time.time() - start) / len(queries)
+            fallbacks = retriever.fallbacks - fallbacks
+            fallback_time = retriever.fallback_time - fallback_time
+            overlaps = []
+            for exact, approx in zip(exact_results, results):
+                # Chunks tied with the exact k-th score are equally good answers
+                kth_score = exact[-1][1] if exact else 0.0
+                expected = {key(chunk) for chunk, score in exact}
+                hits = sum(
+                    1
+                    for chunk, score in approx
+                    if key(chunk) in expected or score >= kth_score
+                )
+                overlaps.append(hits / max(len(exact), 1))
+            print(
+                f"lsh bands={bands} rows={rows}: top-{args.top_k} overlap "
+                f"{sum(overlaps) / len(overlaps):.4f}, build {build_time:.3f} s, "
+                f"query {query_time * 1000:.3f} ms, exact fallback "
+                f"{fallbacks / len(queries):.4f} of queries, "
+                f"{fallback_time / max(fallbacks, 1) * 1000:.3f} ms each"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--repo-dir", dest="repo_dir", required=True)
+    parser.add_argument("-lang", "--language", dest="language", default="java")
+    parser.add_argument(
+        "-c",
+        "--cached-dir",
+        dest="cached_dir",
+        default=os.path.join(CWD, "..", "..", "..", "data", "chunked"),
+    )
+    parser.add_argument("-n", "--num-queries", dest="num_queries", type=int, default=200)
+    parser.add_argument("-k", "--top-k", dest="top_k", type=int, default=10)
+    parser.add_argument("--bands", dest="bands", type=int, nargs="+", default=[16, 32, 64])
+    parser.add_argument("--rows", dest="rows", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--seed", dest="seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,101 @@
+"""Compare the static symbol index backend of `SimilarUsageService` against the language server.
+
+For every row of the dataset, similar usages at the cursor are retrieved with
+both backends on the modified file, the repository on disk being untouched.
+The LSP results are the reference: the static results are scored by precision
+and recall over (file, start of the usage), and the latency of both backends
+is reported. `--no-lsp` only measures the static backend.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from multilspy import SyncLanguageServer
+from multilspy.multilspy_config import MultilspyConfig
+from multilspy.multilspy_logger import MultilspyLogger
+from tree_sitter import Point
+
+CWD = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CWD, ".."))
+from overlay import DocumentOverlay
+from similar_usage import SimilarUsageService
+from symbol_index import get_symbol_index
+
+
+def get_cursor_index(row) -> Point:
+    prompt_lines = row["prompt"].splitlines()
+    return Point(row=len(prompt_lines) - 1, column=len(prompt_lines[-1]))
+
+
+def keys(usages) -> set:
+    return {(os.path.abspath(usage["file_path"]), tuple(usage["range"].start_point)) for usage in usages}
+
+
+def timed_usages(service: SimilarUsageService, file_path: str, cursor_index: Point):
+    start = time.perf_counter()
+    usages = service.get_similar_usages(file_path, "", "", cursor_index)
+    return usages, time.perf_counter() - start
+
+
+def percentiles(timings) -> str:
+    timings = np.array(timings) * 1000
+    return f"mean {timings.mean():.2f} ms, p50 {np.quantile(timings, 0.5):.2f} ms, p95 {np.quantile(timings, 0.95):.2f} ms"
+
+
+def main(args):
+    df = pd.read_json(args.input_path, lines=True)
+    if args.num_rows:
+        df = df.head(args.num_rows)
+    static_timings, lsp_timings, index_timings = [], [], []
+    true_positives = num_static = num_lsp = 0
+    for _, row in df.iterrows():
+        repo_dir = os.path.abspath(os.path.join(args.repos_storage, row["encode"]))
+        file_path = os.path.join(repo_dir, row["metadata"]["file"])
+        overlay = DocumentOverlay({file_path: row["prompt"] + row["right_context"]})
+        cursor_index = get_cursor_index(row)
+
+        start = time.perf_counter()
+        get_symbol_index(repo_dir, args.language)
+        index_timings.append(time.perf_counter() - start)
+        static_service = SimilarUsageService(repo_dir, None, args.language, overlay, backend="static")
+        static_usages, elapsed = timed_usages(static_service, file_path, cursor_index)
+        static_timings.append(elapsed)
+        if args.no_lsp:
+            num_static += len(static_usages)
+            continue
+
+        language_server = SyncLanguageServer.create(
+            MultilspyConfig.from_dict({"code_language": args.language}),
+            MultilspyLogger(),
+            repository_root_path=repo_dir,
+        )
+        with language_server.start_server():
+            lsp_service = SimilarUsageService(repo_dir, language_server, args.language, overlay)
+            lsp_usages, elapsed = timed_usages(lsp_service, file_path, cursor_index)
+        lsp_timings.append(elapsed)
+        static_keys, lsp_keys = keys(static_usages), keys(lsp_usages)
+        true_positives += len(static_keys & lsp_keys)
+        num_static += len(static_keys)
+        num_lsp += len(lsp_keys)
+
+    print(f"Rows: {len(df)}")
+    print(f"static index build/refresh: {percentiles(index_timings)}")
+    print(f"static: {percentiles(static_timings)}, {num_static} usages")
+    if lsp_timings:
+        print(f"lsp (without server start-up): {percentiles(lsp_timings)}, {num_lsp} usages")
+        print(f"static precision: {true_positives / max(num_static, 1):.4f}")
+        print(f"static recall: {true_positives / max(num_lsp, 1):.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", dest="input_path", required=True)
+    parser.add_argument("-r", "--repo-storage", dest="repos_storage", required=True)
+    parser.add_argument("-lang", "--language", dest="language", default="java")
+    parser.add_argument("-n", "--num-rows", dest="num_rows", type=int, default=0)
+    parser.add_argument("--no-lsp", dest="no_lsp", action="store_true", default=False)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,91 @@
+"""Report the error distribution of the approximate token counter on a dataset.
+
+The correction factor and margin are calibrated on a fraction of the rows and
+the error is measured on the others, on the texts whose budgets are checked
+while building prompts: the prompt prefix, the right context and the window
+around the cursor. With `--output` the calibration is saved for
+`--token-calibration` of build_prompt.py and refine.py.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+CWD = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CWD, ".."))
+from common_funcs import Point
+from token_counter import ApproximateTokenCounter, TokenCounter
+from utils import get_window_around_cursor
+
+BUDGETS = [128, 307, 1024]
+
+
+def row_texts(row, token_counter: TokenCounter):
+    prompt_lines = row["prompt"].splitlines()
+    cursor = Point(row=max(len(prompt_lines) - 1, 0), column=0)
+    file_lines = (row["prompt"] + row["right_context"]).splitlines()
+    window = get_window_around_cursor(cursor, file_lines, token_counter=token_counter)
+    return [row["prompt"], row["right_context"], window]
+
+
+def main(args):
+    df = pd.read_json(args.input_path, lines=True)
+    if args.num_rows:
+        df = df.head(args.num_rows)
+    exact_counter = TokenCounter(max_size=0)
+    rows = [row_texts(row, exact_counter) for _, row in df.iterrows()]
+    random.Random(args.seed).shuffle(rows)
+    num_calibration = max(1, int(len(rows) * args.calibration_fraction))
+    calibration_texts = [text for texts in rows[:num_calibration] for text in texts]
+    texts = [text for texts in rows[num_calibration:] for text in texts if text] or calibration_texts
+
+    counter = ApproximateTokenCounter(exact_counter, language=args.language)
+    calibration = counter.calibrate(calibration_texts)
+    print(f"Calibrated on {len(calibration_texts)} texts: {calibration}")
+
+    start = time.time()
+    exact = np.array([exact_counter.count(text) for text in texts], dtype=np.float64)
+    exact_time = time.time() - start
+    start = time.time()
+    estimates = np.array([counter.count(text) for text in texts], dtype=np.float64)
+    estimate_time = time.time() - start
+
+    errors = (estimates - exact) / exact
+    print(f"Evaluated on {len(texts)} texts")
+    print(f"exact: {exact_time:.3f} s, estimate: {estimate_time:.3f} s")
+    print(f"signed relative error: mean {errors.mean():+.4f}")
+    for q in [0.5, 0.9, 0.95, 0.99, 1.0]:
+        print(f"  |error| p{q * 100:g}: {np.quantile(np.abs(errors), q):.4f}")
+    print(f"within margin {counter.margin:.4f}: {np.mean(np.abs(errors) <= counter.margin):.4f}")
+
+    for budget in BUDGETS:
+        counter.decisions = counter.exact_fallbacks = 0
+        decisions = np.array([counter.fits(text, budget) for text in texts])
+        wrong = np.mean(decisions != (exact <= budget))
+        naive_wrong = np.mean((estimates <= budget) != (exact <= budget))
+        print(
+            f"budget {budget}: exact fallback {counter.exact_fallbacks / len(texts):.4f}, "
+            f"wrong fits {wrong:.4f} (without fallback {naive_wrong:.4f})"
+        )
+
+    if args.output_path:
+        counter.save_calibration(args.output_path)
+        print(f"Saved calibration to {args.output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", dest="input_path", required=True)
+    parser.add_argument("-lang", "--language", dest="language", default="java")
+    parser.add_argument("-o", "--output", dest="output_path", default=None)
+    parser.add_argument("-n", "--num-rows", dest="num_rows", type=int, default=0)
+    parser.add_argument(
+        "--calibration-fraction", dest="calibration_fraction", type=float, default=0.5
+    )
+    parser.add_argument("--seed", dest="seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,99 @@
+"""Micro-benchmark of `get_tree_path_at_cursor` against the previous linear scan of `.children`.
+
+Without `--repo-dir`, a synthetic Java class with many members and deeply
+nested blocks is used. Both implementations must return the same paths.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from typing import List
+
+from tree_sitter import Node, Point, Tree
+
+CWD = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CWD, ".."))
+from common_funcs import JAVA_PARSER, get_tree_path_at_cursor
+
+
+def linear_tree_path_at_cursor(ast: Tree, cursor_index: Point) -> List[Node]:
+    """Previous implementation, scanning every sibling at every level"""
+    path = [ast.root_node]
+    while path[-1].child_count > 0:
+        found_child = False
+        for child in path[-1].children:
+            if child.start_point <= cursor_index <= child.end_point:
+                path.append(child)
+                found_child = True
+                break
+        if not found_child:
+            break
+    return path
+
+
+def synthetic_java(num_members: int, depth: int) -> str:
+    lines = ["public class Deep {"]
+    for m in range(num_members):
+        lines.append(f"    private int field{m} = {m};")
+        lines.append(f"    public int method{m}(int a) {{")
+        for d in range(depth):
+            lines.append("    " * (d + 2) + f"if (a > {d}) {{")
+        lines.append("    " * (depth + 2) + f"a = helper{m}(a, field{m});")
+        for d in reversed(range(depth)):
+            lines.append("    " * (d + 2) + "}")
+        lines.append("        return a;")
+        lines.append("    }")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def read_java_files(repo_dir: str) -> List[str]:
+    contents = []
+    for subdir, dirs, files in os.walk(repo_dir):
+        for file in files:
+            if file.endswith(".java"):
+                with open(os.path.join(subdir, file), "r") as f:
+                    contents.append(f.read())
+    return contents
+
+
+def main(args):
+    if args.repo_dir:
+        contents = read_java_files(args.repo_dir)
+    else:
+        contents = [synthetic_java(args.num_members, args.depth)]
+    rng = random.Random(args.seed)
+    cases = []
+    for content in contents:
+        ast = JAVA_PARSER.parse(bytes(content, encoding="utf-8"))
+        lines = content.splitlines() or [""]
+        for _ in range(args.num_cursors):
+            row = rng.randrange(len(lines))
+            cases.append((ast, Point(row, rng.randint(0, len(lines[row])))))
+    print(f"Files: {len(contents)}, cursors: {len(cases)}")
+
+    results = {}
+    for name, function in [
+        ("linear scan", linear_tree_path_at_cursor),
+        ("tree cursor", get_tree_path_at_cursor),
+    ]:
+        start = time.perf_counter()
+        results[name] = [[node.id for node in function(ast, point)] for ast, point in cases]
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {elapsed / len(cases) * 1e6:.1f} us per cursor")
+
+    if results["linear scan"] != results["tree cursor"]:
+        raise AssertionError("Tree paths differ")
+    print("Tree paths are identical")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--repo-dir", dest="repo_dir", default=None)
+    parser.add_argument("--members", dest="num_members", type=int, default=500)
+    parser.add_argument("--depth", dest="depth", type=int, default=12)
+    parser.add_argument("-n", "--num-cursors", dest="num_cursors", type=int, default=2000)
+    parser.add_argument("--seed", dest="seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args)
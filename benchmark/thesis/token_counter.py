@@ -0,0 +1,372 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import re
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from common_funcs import TOKENIZER
+
+logger = logging.getLogger("token_counter")
+
+TOKEN_COUNTER_MODES = ["exact", "approximate"]
+
+WORD_REGEX = re.compile(r"[A-Za-z]+")
+DIGIT_REGEX = re.compile(r"[0-9]")
+PUNCTUATION_REGEX = re.compile(r"[!-/:-@\[-`{-~]")
+SPACE_RUN_REGEX = re.compile(r" {2,}|\t+")
+
+
+def text_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8", errors="surrogatepass"), digest_size=16).digest()
+
+
+class BaseTokenCounter(ABC):
+    """Interface of the token counters, whose counts are exact or estimated"""
+
+    # Whether counts are estimates, whose budget cuts are checked with `fits`
+    estimated = False
+
+    @property
+    @abstractmethod
+    def num_special_tokens(self) -> int:
+        pass
+
+    @abstractmethod
+    def count(self, text: str) -> int:
+        pass
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        return [self.count(text) for text in texts]
+
+    def fits(self, text: str, max_tokens: float) -> bool:
+        """Whether `text` counts at most `max_tokens` tokens"""
+        return self.count(text) <= max_tokens
+
+    @abstractmethod
+    def line_prefix_sums(self, lines: List[str]) -> List[int]:
+        pass
+
+
+class TokenCounter(BaseTokenCounter):
+    """Token ids and counts of texts, memoized in a bounded LRU keyed by content hash.
+
+    The same prefix, window and snippet texts are tokenized several times per
+    row, every one of them is only tokenized once as long as it stays in the
+    cache. With `cache_path` the cache is loaded from and saved to disk, so it
+    survives across runs of the same tokenizer.
+    """
+
+    def __init__(
+        self,
+        tokenizer=TOKENIZER,
+        max_size: int = 65536,
+        cache_path: Optional[str] = None,
+    ):
+        self.tokenizer = tokenizer
+        self.max_size = max_size
+        self.cache_path = cache_path
+        self.cache: "OrderedDict[bytes, List[int]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Seconds spent in the tokenizer on cache misses
+        self.tokenizer_time = 0.0
+        self._num_special_tokens: Optional[int] = None
+        if cache_path:
+            self.load(cache_path)
+
+    def _tokenizer_name(self) -> str:
+        return getattr(self.tokenizer, "name_or_path", type(self.tokenizer).__name__)
+
+    def _get(self, key: bytes) -> Optional[List[int]]:
+        input_ids = self.cache.get(key)
+        if input_ids is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.cache.move_to_end(key)
+        return input_ids
+
+    def _put(self, key: bytes, input_ids: List[int]):
+        self.cache[key] = input_ids
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    def encode(self, text: str) -> List[int]:
+        key = text_key(text)
+        input_ids = self._get(key)
+        if input_ids is None:
+            start = time.perf_counter()
+            input_ids = self.tokenizer(text)["input_ids"]
+            self.tokenizer_time += time.perf_counter() - start
+            self._put(key, input_ids)
+        return input_ids
+
+    def encode_batch(self, texts: List[str]) -> List[List[int]]:
+        """Token ids of every text, the misses being tokenized in one batched call"""
+        keys = [text_key(text) for text in texts]
+        results = [self._get(key) for key in keys]
+        missing = {}
+        for i, input_ids in enumerate(results):
+            if input_ids is None:
+                missing.setdefault(keys[i], []).append(i)
+        if missing:
+            start = time.perf_counter()
+            encoded = self.tokenizer(
+                [texts[positions[0]] for positions in missing.values()]
+            )["input_ids"]
+            self.tokenizer_time += time.perf_counter() - start
+            for (key, positions), input_ids in zip(missing.items(), encoded):
+                self._put(key, input_ids)
+                for i in positions:
+                    results[i] = input_ids
+        return results
+
+    def count(self, text: str) -> int:
+        return len(self.encode(text))
+
+    @property
+    def num_special_tokens(self) -> int:
+        """Tokens the tokenizer adds to any text, e.g. BOS"""
+        if self._num_special_tokens is None:
+            self._num_special_tokens = len(self.tokenizer("")["input_ids"])
+        return self._num_special_tokens
+
+    def line_prefix_sums(self, lines: List[str]) -> List[int]:
+        """Cumulative token counts of `lines`, from one tokenization of the joined lines.
+
+        Every token of "\n".join(lines) is attributed to the line it starts in,
+        special tokens left out, so lines[a:b] joined count about
+        `sums[b] - sums[a] + num_special_tokens` tokens. Tokens merging across
+        a line break make this approximate.
+        """
+        text = "\n".join(lines)
+        key = b"lines:" + text_key(text)
+        sums = self._get(key)
+        if sums is None:
+            start = time.perf_counter()
+            offsets = self.tokenizer(
+                text, add_special_tokens=False, return_offsets_mapping=True
+            )["offset_mapping"]
+            self.tokenizer_time += time.perf_counter() - start
+            line_starts = np.cumsum([0] + [len(line) + 1 for line in lines[:-1]])
+            token_starts = np.array([token_start for token_start, _ in offsets], dtype=np.int64)
+            token_lines = np.searchsorted(line_starts, token_starts, side="right") - 1
+            counts = np.bincount(token_lines, minlength=len(lines))
+            sums = [0, *np.cumsum(counts).tolist()]
+            self._put(key, sums)
+        return sums
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        return [len(input_ids) for input_ids in self.encode_batch(texts)]
+
+    def stats(self) -> dict:
+        """Hit/miss counters, with the tokenizer time the hits are estimated to save"""
+        lookups = self.hits + self.misses
+        time_per_miss = self.tokenizer_time / self.misses if self.misses else 0.0
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self.cache),
+            "tokenizer_time": self.tokenizer_time,
+            "saved_time": self.hits * time_per_miss,
+        }
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.tokenizer_time = 0.0
+
+    def load(self, cache_path: str):
+        self.cache_path = cache_path
+        if not os.path.exists(cache_path):
+            return
+        try:
+            with open(cache_path, "rb") as f:
+                tokenizer_name, entries = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError) as e:
+            logger.warning(f"Discard corrupted token cache {cache_path}: {e}")
+            return
+        if tokenizer_name != self._tokenizer_name():
+            logger.warning(f"Discard token cache {cache_path} of tokenizer {tokenizer_name}")
+            return
+        for key, input_ids in entries:
+            self._put(key, input_ids)
+
+    def save(self, cache_path: Optional[str] = None):
+        cache_path = cache_path or self.cache_path
+        if not cache_path:
+            return
+        dir_path = os.path.dirname(cache_path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        tmp_path = cache_path + f".{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((self._tokenizer_name(), list(self.cache.items())), f)
+        os.replace(tmp_path, cache_path)
+
+
+class ApproximateTokenCounter(BaseTokenCounter):
+    """Token counts estimated from character classes, without tokenizing.
+
+    Letter runs count about one token per 4 letters, digits and punctuation
+    one token each, newlines and runs of spaces one token, and every extra
+    utf-8 byte of non-ASCII characters one byte-fallback token. The sum is
+    scaled by a per-language correction factor fitted with `calibrate`.
+    `margin` is the relative error the estimate stays within on the
+    calibration data; `fits` only asks the exact counter when the estimate is
+    within that margin of the budget.
+    """
+
+    estimated = True
+    default_factor = 1.0
+    # Conservative until calibrated on the dataset
+    default_margin = 0.25
+
+    def __init__(
+        self,
+        exact_counter: "TokenCounter",
+        language: str = "java",
+        calibration_path: Optional[str] = None,
+        max_cached_files: int = 256,
+    ):
+        self.exact_counter = exact_counter
+        self.language = language
+        # language -> {"factor", "margin"}
+        self.calibration: Dict[str, dict] = {}
+        self.max_cached_files = max_cached_files
+        self.line_sums_cache: "OrderedDict[bytes, List[int]]" = OrderedDict()
+        self.exact_fallbacks = 0
+        self.decisions = 0
+        if calibration_path:
+            self.load_calibration(calibration_path)
+
+    @property
+    def num_special_tokens(self) -> int:
+        return self.exact_counter.num_special_tokens
+
+    @property
+    def factor(self) -> float:
+        return self.calibration.get(self.language, {}).get("factor", self.default_factor)
+
+    @property
+    def margin(self) -> float:
+        return self.calibration.get(self.language, {}).get("margin", self.default_margin)
+
+    @staticmethod
+    def raw_estimate(text: str) -> float:
+        """Uncorrected token estimate of `text`, special tokens left out"""
+        words = WORD_REGEX.findall(text)
+        num_letters = sum(map(len, words))
+        return (
+            (num_letters + 3 * len(words)) / 4
+            + len(DIGIT_REGEX.findall(text))
+            + len(PUNCTUATION_REGEX.findall(text))
+            + text.count("\n")
+            + len(SPACE_RUN_REGEX.findall(text))
+            + len(text.encode("utf-8", errors="surrogatepass")) - len(text)
+        )
+
+    def count(self, text: str) -> int:
+        return self.num_special_tokens + round(self.factor * self.raw_estimate(text))
+
+    def fits(self, text: str, max_tokens: float) -> bool:
+        self.decisions += 1
+        estimate = self.count(text)
+        if estimate / (1 - self.margin) <= max_tokens:
+            return True
+        if estimate / (1 + self.margin) > max_tokens:
+            return False
+        self.exact_fallbacks += 1
+        return self.exact_counter.fits(text, max_tokens)
+
+    def line_prefix_sums(self, lines: List[str]) -> List[int]:
+        key = text_key("\n".join(lines))
+        sums = self.line_sums_cache.get(key)
+        if sums is None:
+            sums = [0]
+            for line in lines:
+                # The line break of the joined lines is one more token
+                sums.append(sums[-1] + round(self.factor * (self.raw_estimate(line) + 1)))
+            self.line_sums_cache[key] = sums
+            while len(self.line_sums_cache) > self.max_cached_files:
+                self.line_sums_cache.popitem(last=False)
+        else:
+            self.line_sums_cache.move_to_end(key)
+        return sums
+
+    def calibrate(self, texts: List[str], language: Optional[str] = None) -> dict:
+        """Fit the correction factor and margin of `language` on `texts`"""
+        language = language or self.language
+        raw = np.array([self.raw_estimate(text) for text in texts], dtype=np.float64)
+        exact = np.array(self.exact_counter.count_batch(texts), dtype=np.float64)
+        exact -= self.num_special_tokens
+        factor = float(exact.sum() / max(raw.sum(), 1.0))
+        estimates = np.round(factor * raw) + self.num_special_tokens
+        exact += self.num_special_tokens
+        errors = np.abs(estimates - exact) / exact
+        self.calibration[language] = {
+            "factor": factor,
+            "margin": min(float(np.quantile(errors, 0.99)), 0.9) if len(texts) else self.default_margin,
+        }
+        self.line_sums_cache.clear()
+        return self.calibration[language]
+
+    def load_calibration(self, calibration_path: str):
+        with open(calibration_path, "r") as f:
+            self.calibration.update(json.load(f))
+        self.line_sums_cache.clear()
+
+    def save_calibration(self, calibration_path: str):
+        with open(calibration_path, "w") as f:
+            json.dump(self.calibration, f, indent=2)
+
+    def stats(self) -> dict:
+        return {
+            "decisions": self.decisions,
+            "exact_fallbacks": self.exact_fallbacks,
+            **self.exact_counter.stats(),
+        }
+
+
+# Shared by every call site of the process
+TOKEN_COUNTER = TokenCounter()
+APPROXIMATE_TOKEN_COUNTER = ApproximateTokenCounter(TOKEN_COUNTER)
+_active_counter: BaseTokenCounter = TOKEN_COUNTER
+
+
+def get_token_counter() -> BaseTokenCounter:
+    """Counter used for token budgets, see `set_token_counter_mode`"""
+    return _active_counter
+
+
+def set_token_counter_mode(
+    mode: str, language: str = "java", calibration_path: Optional[str] = None
+):
+    """Count budget tokens exactly, or with the calibrated estimate in "approximate" mode.
+
+    The approximate mode needs a calibration of `language`, see
+    tests/bench_token_estimate.py: without one the estimate has no known error
+    bound, and budgets could be exceeded without any exact check.
+    """
+    global _active_counter
+    if mode not in TOKEN_COUNTER_MODES:
+        raise NotImplementedError(f"Token counter mode {mode} is not supported")
+    if mode == "approximate":
+        if not calibration_path:
+            raise ValueError("The approximate token counter needs a calibration file")
+        APPROXIMATE_TOKEN_COUNTER.language = language
+        APPROXIMATE_TOKEN_COUNTER.load_calibration(calibration_path)
+        if language not in APPROXIMATE_TOKEN_COUNTER.calibration:
+            raise ValueError(f"{calibration_path} has no calibration for {language}")
+        _active_counter = APPROXIMATE_TOKEN_COUNTER
+    else:
+        _active_counter = TOKEN_COUNTER
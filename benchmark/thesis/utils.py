@@ -1,12 +1,12 @@
 import os
-from typing import List, TypeVar
+from typing import List, Optional, TypeVar
 from common_funcs import (
     COMMON_STOPS,
     LANGUAGE_COMMENT_SYMBOL,
     SEP_REGEX,
-    TOKENIZER,
     Point,
 )
+from token_counter import TOKEN_COUNTER, BaseTokenCounter, get_token_counter
 import logging
 
 logger = logging.getLogger("utils")
@@ -14,60 +14,83 @@ logger = logging.getLogger("utils")
 Snippet = TypeVar("Snippet")
 
 
+def _first_true(low: int, high: int, predicate) -> int:
+    """Smallest i in [low, high) for which the monotone `predicate` holds, `high` if none"""
+    while low < high:
+        middle = (low + high) // 2
+        if predicate(middle):
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
 def get_window_around_cursor(
     cursor: Point,
     file_lines: List[str],
     window_size: int = 128,
-    tokenizer: any = TOKENIZER,
+    token_counter: Optional[BaseTokenCounter] = None,
 ) -> str:
     """
     Get a window of text around the cursor position that fits within the token window size.
 
+    The window first grows symmetrically around the cursor line, then by whole
+    lines above and below. The file is tokenized once into per-line prefix
+    sums, on which every boundary is found by binary search. Tokens merging
+    across line breaks make these sums approximate, so the chosen window is
+    counted once with the counter, and its lines farthest from the cursor are
+    dropped until it fits.
+
     Args:
         cursor (Point): Current cursor position containing row information
         file_lines (List[str]): List of file lines
-        tokenizer: Tokenizer instance to encode text
         window_size (int): Maximum number of tokens allowed in window
+        token_counter (BaseTokenCounter): Token counter, the active one by default
 
     Returns:
         str: Text window around cursor within token limit
     """
+    token_counter = token_counter or get_token_counter()
     current_row = cursor.row
-    start_line = current_row
-    end_line = current_row + 1
     max_line = len(file_lines)
+    sums = token_counter.line_prefix_sums(file_lines)
+    num_special_tokens = token_counter.num_special_tokens
+
+    def fits(start_line: int, end_line: int, max_tokens: int) -> bool:
+        return sums[end_line] - sums[start_line] + num_special_tokens <= max_tokens
+
+    # Largest symmetric window within the limit
+    max_half = min(current_row, max_line - current_row - 1)
+    half = (
+        _first_true(
+            0,
+            max_half + 1,
+            lambda half: not fits(current_row - half, current_row + 1 + half, window_size),
+        )
+        - 1
+    )
+    if half >= 0:
+        start_line, end_line = current_row - half, current_row + 1 + half
+    else:
+        # Even the cursor line is too large, it is then only tried as a line above
+        start_line = end_line = min(current_row + 1, max_line)
+
+    # Extend by whole lines above, then below, while strictly below the limit
+    start_line = _first_true(0, start_line, lambda line: fits(line, end_line, window_size - 1))
+    end_line = (
+        _first_true(
+            end_line + 1, max_line + 1, lambda line: not fits(start_line, line, window_size - 1)
+        )
+        - 1
+    )
 
-    # Initial expansion to find boundaries
-    while start_line >= 0 and end_line <= max_line:
-        current_window = "\n".join(file_lines[start_line:end_line])
-        if len(tokenizer(current_window)["input_ids"]) > window_size:
-            break
-        start_line -= 1
-        end_line += 1
-
-    # Adjust boundaries to last valid window
-    start_line += 1
-    end_line -= 1
     window = "\n".join(file_lines[start_line:end_line])
-
-    # Fine-tune the window by adding lines one at a time
-    def can_add_line(test_window: str) -> bool:
-        return len(tokenizer(test_window)["input_ids"]) < window_size
-
-    # Try to add lines above
-    for line_no in range(start_line - 1, -1, -1):
-        test_window = file_lines[line_no] + "\n" + window
-        if not can_add_line(test_window):
-            break
-        window = test_window
-
-    # Try to add lines below
-    for line_no in range(end_line, max_line):
-        test_window = window + "\n" + file_lines[line_no]
-        if not can_add_line(test_window):
-            break
-        window = test_window
-
+    while start_line < end_line and not token_counter.fits(window, window_size):
+        if current_row - start_line >= end_line - 1 - current_row:
+            start_line += 1
+        else:
+            end_line -= 1
+        window = "\n".join(file_lines[start_line:end_line])
     return window
 
 
@@ -84,7 +107,7 @@ def filter_snippets_already_in_caret_window(
 
 
 def count_tokens(content: str) -> int:
-    return len(TOKENIZER(content)["input_ids"])
+    return get_token_counter().count(content)
 
 
 def shortest_relative_paths(paths: List[str]) -> List[str]:
@@ -219,8 +242,17 @@ def jaccard_similarity(list1: List[int], list2: List[int]):
 
 
 def get_ranked_snippets(query_text: str, snippets: List[Snippet]):
-    encoded_query_text = TOKENIZER(query_text)["input_ids"]
-    encoded_snippets = list(map(lambda snippet: TOKENIZER(snippet["content"])["input_ids"], snippets))
+    encoded_query_text = TOKEN_COUNTER.encode(query_text)
+    # Snippets carrying their token ids are not tokenized again
+    encoded_missing = iter(
+        TOKEN_COUNTER.encode_batch(
+            [snippet["content"] for snippet in snippets if "encoded" not in snippet]
+        )
+    )
+    encoded_snippets = [
+        snippet["encoded"] if "encoded" in snippet else next(encoded_missing)
+        for snippet in snippets
+    ]
     scores = list(map(lambda encoded_snippet: jaccard_similarity(encoded_query_text, encoded_snippet), encoded_snippets))
     ranked_snippets = sorted(zip(snippets, scores), key=lambda x: x[1], reverse=True)
     return [snippet for snippet, score in ranked_snippets]